@@ -0,0 +1,361 @@
+"""
+Name: benchmark
+Version: 0.1
+Author: CIA
+
+Benchmark for copyDataFromRomToRom, on generated data (real ROMs and
+definitions can't be shared).
+
+Generates EcuFlash-like definition sets - a bitbase, a chain of <include>
+files, 1D / 2D / 3D tables, static axes and many scalings - with random ROMs
+matching them, then times each phase of a copy separately. The results are
+written as JSON, to compare runs over time.
+
+Usage:
+    python benchmark.py --tables 5000 --scalings 2000 --romsize 1048576 --repeat 5 --output bench.json
+"""
+import sys
+import os
+import logging
+import argparse
+import random
+import tempfile
+import shutil
+import time
+import json
+import gc
+import statistics
+import platform
+
+import copyDataFromRomToRom as cdr
+
+
+"""
+==========================
+    Errors
+==========================
+"""
+error_rom_too_small = "ROM of {0} bytes is too small for {1} tables ({2} bytes needed)"
+error_invalid_value = "{0} must be at least {1}"
+
+info_generated = "Generated {0} tables, {1} scalings, {2} definition files per ROM in {3}"
+info_run = "Run {0}/{1}"
+info_phase = "\t{0:22} min {1:9.4f}s  median {2:9.4f}s"
+info_saved = "Results saved to {0}"
+
+# Phases, in run order.
+phases = ["_loadDefs", "_loadScalings", "_loadTables", "getCommonTablesWith", "copyRomData", "dumpToFile"]
+
+# Generated layout.
+rom_id_address = 0x2000
+tables_start = 0x10000
+bench_storage_types = ["uint8", "uint16", "int16", "uint32", "float"]
+bench_table_kinds = ["1D", "2D", "2D static", "3D"]
+
+bench_version = 1
+
+
+"""
+==========================
+    Generators
+==========================
+"""
+
+class DefsGenerator(object):
+    """Synthetic EcuFlash definitions for two versions of the same ROM.
+
+    Table templates (type, scaling, axes) go in the bitbase and the include
+    chain files, the addresses in the ROM file. The second ROM moves <moved>
+    of the tables, so not everything matches by address.
+    """
+
+    def __init__(self, tables, scalings, chain=3, moved=0.1, seed=1):
+        self.tables = tables
+        self.scalings = scalings
+        self.chain = chain
+        self.moved = moved
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.templates = self._templates()
+
+    """ =========== Helpers. ============ """
+
+    def _scalingXml(self, idx):
+        storagetype = bench_storage_types[idx % len(bench_storage_types)]
+        endian = "little" if idx % 7 == 0 else "big"
+        return ('<scaling name="scaling{0}" units="u" toexpr="x*{1}" frexpr="x/{1}" format="%.2f" min="0" max="100" '
+                'inc="1" storagetype="{2}" endian="{3}"/>').format(idx, 0.25 * (1 + idx % 8), storagetype, endian)
+
+    def _templates(self):
+        """List (name, kind, scaling, axis scaling, elements, chain file index) of all tables."""
+        templates = []
+        for idx in range(self.tables):
+            kind = bench_table_kinds[idx % len(bench_table_kinds)]
+            scaling = "scaling{0}".format(self.rnd.randrange(self.scalings))
+            axis_scaling = "scaling{0}".format(self.rnd.randrange(self.scalings))
+            elements = (self.rnd.randint(4, 16), self.rnd.randint(4, 16))
+            templates.append(("Table {0}".format(idx), kind, scaling, axis_scaling, elements, idx % (self.chain - 1)))
+        return templates
+
+    def _templateXml(self, template):
+        name, kind, scaling, axis_scaling, elements, _ = template
+        if kind == "1D":
+            return '<table name="{0}" category="Bench" type="1D" scaling="{1}"/>'.format(name, scaling)
+        if kind == "2D":
+            return ('<table name="{0}" category="Bench" type="2D" scaling="{1}">'
+                    '<table name="Y" type="Y Axis" scaling="{2}"/></table>').format(name, scaling, axis_scaling)
+        if kind == "2D static":
+            data = "".join("<data>{0}</data>".format(x) for x in range(elements[1]))
+            return ('<table name="{0}" category="Bench" type="2D" scaling="{1}">'
+                    '<table name="Y" type="Static Y Axis" elements="{2}">{3}</table></table>').format(
+                        name, scaling, elements[1], data)
+        return ('<table name="{0}" category="Bench" type="3D" scaling="{1}">'
+                '<table name="X" type="X Axis" scaling="{2}"/><table name="Y" type="Y Axis" scaling="{2}"/>'
+                '</table>').format(name, scaling, axis_scaling)
+
+    def _itemSize(self, scaling):
+        storagetype = bench_storage_types[int(scaling[len("scaling"):]) % len(bench_storage_types)]
+        return cdr.storage_types[storagetype][0]
+
+    def _place(self, template, address):
+        """Place a table at address. Returns ((name, data address, [(axis, address, elements)]), next address)."""
+        name, kind, scaling, axis_scaling, elements, _ = template
+        itemsize = self._itemSize(scaling)
+        axis_size = self._itemSize(axis_scaling)
+        if kind == "1D":
+            entry = (name, address, [])
+            address += 4
+        elif kind == "2D":
+            axis = address + elements[1] * itemsize
+            entry = (name, address, [("Y", axis, elements[1])])
+            address = axis + elements[1] * axis_size
+        elif kind == "2D static":
+            entry = (name, address, [])
+            address += elements[1] * itemsize
+        else:
+            axis_x = address + elements[0] * elements[1] * itemsize
+            axis_y = axis_x + elements[0] * axis_size
+            entry = (name, address, [("X", axis_x, elements[0]), ("Y", axis_y, elements[1])])
+            address = axis_y + elements[1] * axis_size
+        return entry, (address + 3) & ~3
+
+    def _layout(self, shifted):
+        """List (name, data address, [(axis, address, elements)]) and the end address.
+
+        With <shifted>, the moved tables are placed again after all the others.
+        """
+        layout = []
+        address = tables_start
+        for template in self.templates:
+            entry, address = self._place(template, address)
+            layout.append(entry)
+
+        if shifted:
+            rnd = random.Random(self.seed)
+            for idx, template in enumerate(self.templates):
+                if rnd.random() < self.moved:
+                    layout[idx], address = self._place(template, address)
+        return layout, address
+
+    """ =========== Public. ============= """
+
+    def write(self, folder, xmlid, shifted=False):
+        """Write the definition files of one ROM. Returns (paths base first, end address)."""
+        os.makedirs(folder, exist_ok=True)
+
+        names = ["32BITBASE"] + ["BASE{1}_{0}".format(xmlid, x) for x in range(1, self.chain - 1)] + [xmlid]
+        bodies = [[] for _ in names]
+        bodies[0] += [self._scalingXml(x) for x in range(self.scalings)]
+        bodies[0].append('<table name="ECU Identifier" category="Bench" type="1D" scaling="scaling0"/>')
+        for template in self.templates:
+            bodies[template[5]].append(self._templateXml(template))
+
+        layout, end = self._layout(shifted)
+        rom = bodies[-1]
+        rom.append('<table name="ECU Identifier" address="{0:x}"/>'.format(rom_id_address))
+        for name, address, axes in layout:
+            subs = "".join('<table name="{0}" address="{1:x}" elements="{2}"/>'.format(*x) for x in axes)
+            rom.append('<table name="{0}" address="{1:x}">{2}</table>'.format(name, address, subs))
+
+        paths = []
+        for idx, name in enumerate(names):
+            romid = "<romid><xmlid>{0}</xmlid></romid>".format(name)
+            if idx == len(names) - 1:
+                romid = ("<romid><xmlid>{0}</xmlid><internalidaddress>{1:x}</internalidaddress>"
+                         "<internalidstring>{0}</internalidstring></romid>").format(name, rom_id_address)
+            include = "<include>{0}</include>".format(names[idx - 1]) if idx else ""
+            path = os.path.join(folder, name + ".xml")
+            with open(path, "w") as fp:
+                fp.write("<rom>\n{0}\n{1}\n{2}\n</rom>\n".format(romid, include, "\n".join(bodies[idx])))
+            paths.append(path)
+        return paths, end
+
+
+def generateRom(path, size, xmlid, seed):
+    """Random ROM image, with its id at the id address."""
+    rnd = random.Random(seed)
+    content = bytearray(rnd.getrandbits(8 * size).to_bytes(size, "big"))
+    content[rom_id_address:rom_id_address + len(xmlid)] = xmlid.encode("ascii")
+    with open(path, "wb") as fp:
+        fp.write(content)
+
+
+"""
+==========================
+    Benchmark
+==========================
+"""
+
+class Benchmark(object):
+    """Time the copy phases on a generated ROM pair, <repeat> times."""
+
+    def __init__(self, folder, tables, scalings, chain, romsize, address_match=True, seed=1):
+        self.folder = folder
+        self.address_match = address_match
+        self.config = {"tables": tables, "scalings": scalings, "chain": chain, "romsize": romsize,
+                       "address_match": address_match, "seed": seed}
+
+        generator = DefsGenerator(tables, scalings, chain, seed=seed)
+        self.source_defs, end_s = generator.write(os.path.join(folder, "defs_source"), "BENCH001")
+        self.dest_defs, end_d = generator.write(os.path.join(folder, "defs_dest"), "BENCH002", shifted=True)
+        needed = max(end_s, end_d)
+        cdr.check(needed <= romsize, error_rom_too_small, romsize, tables, needed)
+
+        self.source_rom = os.path.join(folder, "source.bin")
+        self.dest_orig = os.path.join(folder, "dest.orig")
+        self.dest_rom = os.path.join(folder, "dest.bin")
+        generateRom(self.source_rom, romsize, "BENCH001", seed)
+        generateRom(self.dest_orig, romsize, "BENCH002", seed + 1)
+        logging.info(info_generated.format(tables, scalings, len(self.source_defs), folder))
+
+    """ =========== Helpers. ============ """
+
+    def _timed(self, timings, phase, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+        return result
+
+    def _run(self):
+        """One full copy, without cache. Returns (timings, tables, bytes)."""
+        shutil.copyfile(self.dest_orig, self.dest_rom)
+        source = cdr.RomHandler(self.source_rom, self.source_defs, readonly=True)
+        dest = cdr.RomHandler(self.dest_rom, self.dest_defs)
+
+        timings = {}
+        for handler in (source, dest):
+            handler.loadRom()
+            self._timed(timings, "_loadDefs", handler._loadDefs)
+            self._timed(timings, "_loadScalings", handler._loadScalings)
+            self._timed(timings, "_loadTables", handler._loadTables)
+
+        tables = self._timed(timings, "getCommonTablesWith", cdr.RomsOps.getCommonTablesWith,
+                             source, dest, self.address_match)
+        plan = self._timed(timings, "copyRomData", cdr.RomsOps.copyRomData, source, dest, self.address_match)
+        self._timed(timings, "dumpToFile", dest.dumpToFile)
+        return timings, len(tables), plan.byteCount()
+
+    """ =========== Public. ============= """
+
+    def run(self, repeat):
+        """Run the benchmark. Returns the results as dict."""
+        runs = []
+        for idx in range(repeat):
+            logging.info(info_run.format(idx + 1, repeat))
+            # Parsed definition layers are shared while referenced - start each run cold
+            gc.collect()
+            runs.append(self._run())
+
+        results = {}
+        for phase in phases:
+            values = [x[0][phase] for x in runs]
+            results[phase] = {"min": min(values), "median": statistics.median(values),
+                              "mean": statistics.mean(values), "runs": values}
+        total = [sum(x[0].values()) for x in runs]
+        results["total"] = {"min": min(total), "median": statistics.median(total),
+                            "mean": statistics.mean(total), "runs": total}
+
+        return {
+            "version": bench_version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": cdr.np is not None,
+            "config": self.config,
+            "repeat": repeat,
+            "common_tables": runs[0][1],
+            "copied_bytes": runs[0][2],
+            "phases": results
+            }
+
+
+"""
+==========================
+    Main Logic
+==========================
+"""
+
+def main(args):
+    """Main."""
+    folder = args.keep or tempfile.mkdtemp(prefix="cdr_bench_")
+    try:
+        benchmark = Benchmark(folder, args.tables, args.scalings, args.chain, args.romsize,
+                              args.address_match, args.seed)
+        results = benchmark.run(args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    for phase in phases + ["total"]:
+        logging.info(info_phase.format(phase, results["phases"][phase]["min"], results["phases"][phase]["median"]))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=1)
+        logging.info(info_saved.format(args.output))
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    return results
+
+
+def parseArgs():
+    """Parsing arguments."""
+    parser = argparse.ArgumentParser(description='Benchmark copyDataFromRomToRom on generated ROMs and definitions.')
+    parser.add_argument('--tables', dest='tables', type=int, default=2000,
+                        help='Number of tables (default: 2000).')
+    parser.add_argument('--scalings', dest='scalings', type=int, default=1000,
+                        help='Number of scalings (default: 1000).')
+    parser.add_argument('--chain', dest='chain', type=int, default=3,
+                        help='Definition files per ROM: bitbase, include chain, ROM file (default: 3).')
+    parser.add_argument('--romsize', dest='romsize', type=int, default=1 << 20,
+                        help='ROM size in bytes (default: 1048576).')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                        help='Number of runs (default: 3).')
+    parser.add_argument('--seed', dest='seed', type=int, default=1,
+                        help='Random seed of the generated data (default: 1).')
+    parser.add_argument('--nomatch', '-n', dest='address_match', action='store_const',
+                        const=False, default=True,
+                        help='Match tables without address, like copyDataFromRomToRom --nomatch.')
+    parser.add_argument('--keep', dest='keep', default=None,
+                        help='Generate the data in this folder and keep it (default: temporary folder).')
+    parser.add_argument('--output', '-o', dest='output', default=None,
+                        help='Write the results as JSON to this file (default: standard output).')
+
+    args = parser.parse_args()
+    return args
+
+
+def validateInput(args):
+    """Validate the input."""
+    for name, value, minimum in (("Tables", args.tables, 1), ("Scalings", args.scalings, 1),
+                                 ("Chain", args.chain, 2), ("Repeat", args.repeat, 1)):
+        if value < minimum:
+            cdr.myerror(error_invalid_value.format(name, minimum))
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    validateInput(args)
+    logging.basicConfig(level=logging.INFO)
+
+    main(args)
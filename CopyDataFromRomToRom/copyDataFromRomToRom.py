@@ -1,9 +1,35 @@
 """
 Name: copyDataFromRomToRom
-Version: 0.2
+Version: 0.3
 Author: CIA
 
 Changelog:
+V 0.3
+    - Added on-disk cache of the processed definitions (tables & scalings).
+    - Definitions are streamed (iterparse) in a single pass, no XML trees are kept.
+    - Added definitions repository index, with ROM id detection and <include> chain resolution.
+    - Tables are stored as typed records (RomTable / RomAxis) with parsed addresses and sizes.
+    - Table matching uses a signature index (N ROMs common tables, compatibility matrix).
+    - Copy is done through a merged copy plan, that can be saved, inspected (dry run) and replayed.
+    - ROMs are memory mapped; only the changed ranges of the destination are written back (journaled).
+    - Added batch mode: manifest of ROM pairs, run in a process pool, definitions parsed once per set.
+    - Parsed definition files are shared (by content hash) between all RomHandlers of the process.
+    - ROMs and definition files are loaded concurrently (LoadPipeline).
+    - Added relocation check for --nomatch: axes are searched in the destination ROM (needs numpy).
+    - All EcuFlash storage types and endianness are known; tables can be decoded to numpy arrays.
+    - Added --convert: tables whose scaling changed are converted through toexpr / frexpr (needs numpy).
+    - Added address index over table spans: address lookup, overlaps and free space.
+    - Added --diff: differing byte ranges between the ROMs, by table / axis, with unknown regions.
+    - Added table hashes: unchanged tables are skipped, copied ones verified, hashes saved next to the ROM.
+    - Added --patch / --applypatch / --revertpatch: binary patches instead of full ROM writes.
+    - Added --checksum: fix the checksum table of 32-bit Subaru ROMs after copy (needs numpy); --checksumverify checks all of it.
+    - Added benchmark.py: timings of each phase on generated definitions and ROMs.
+    - Added --profile / --profiledump and the Metrics API; debug messages are only formatted in debug mode.
+    - Added table selection (--include / --exclude / --selection): names, globs, regexes and categories,
+      applied while parsing. table_blacklist is always enforced through it.
+    - Added --watch: keeps both ROMs loaded and copies again when a ROM or definition file changes.
+    - Added --fleet: value statistics of every table over many ROMs of one definitions set (needs numpy).
+    - Every copy is checked against the destination before it: size, copied ranges and nothing else changed.
 V 0.2
     - Added table_blacklist - with ECU Identifier - so i don't brick my ECU again.
 """
@@ -14,6 +40,32 @@ import logging
 import argparse
 import pprint
 import traceback
+import hashlib
+import pickle
+import tempfile
+import json
+import mmap
+import struct
+import concurrent.futures
+import weakref
+import ast
+import bisect
+import re
+import fnmatch
+import time
+import contextlib
+import cProfile
+import tracemalloc
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 """
@@ -29,27 +81,182 @@ error_invalid_scaling = "Found invalid scaling {0} - does not contain field {1}"
 error_invalid_common_tables = "No tables to copy - common tables - received None."
 error_inpropper_argument = "I've received an inpropper argument type: {0}"
 error_invalid_type_of_object = "Invalid type of object received"
+error_cache_read = "Could not read cache entry {0} - ignoring it ({1})"
+error_cache_write = "Could not write cache entry {0} - ignoring it ({1})"
+error_index_read = "Could not read definitions index {0} - rebuilding it ({1})"
+error_unknown_xmlid = "Definition {0} is not in the definitions repository {1}"
+error_include_loop = "Include loop found while resolving {0}: {1}"
+error_rom_not_identified = "Could not identify ROM {0} with any definition from {1}"
+error_missing_defs = "No definitions for {0} - give a definitions folder or --defsrepo"
+error_plan_protected = "Copy plan block {0} ({1} bytes, tables: {2}) overwrites blacklisted table {3}"
+error_plan_size_mismatch = "Table {0} has different sizes between ROMs: {1} / {2}"
+error_plan_overlap = "Overlapping destination writes at {0}: {1} / {2}"
+error_plan_version = "Unsupported copy plan {0}"
+error_plan_rom_size = "Copy plan was made for a {0} of {1} bytes, got {2} bytes"
+error_readonly_rom = "ROM {0} is opened read-only"
+error_set_data_size = "Invalid data size for {0} at {1}: expected {2} bytes, got {3}"
+error_invalid_journal = "Invalid journal file {0}"
+error_invalid_patch = "Invalid patch file {0}"
+error_patch_base = "ROM {0} is not the ROM patch {1} was made for ({2})"
+error_patch_result = "ROM {0} does not match patch {1} after writing it"
+error_checksum_not_found = "Could not find the checksum table of {0} - give its address with --checksumtable"
+error_checksum_table = "No valid checksum table at {0} in {1}"
+warning_checksum_invalid = "\t\tChecksum {0} -> {1} is still invalid"
+warning_pending_journal = "ROM {0} has an unfinished write journal {1} - it is not applied on a read-only ROM"
+error_invalid_manifest = "Invalid batch manifest {0}: {1}"
+error_batch_dest_conflict = "ROM {0} is written by more than one batch job, or is also a source"
+error_numpy_missing = "{0} needs numpy - install it with: pip install numpy"
+error_encode_size = "Can't encode {0} values in {1} of {2}: expected {3} values"
+error_static_axis = "Axis {0} of {1} is static - it has no data in the ROM"
+error_diff_replay = "--diff needs the definitions of both ROMs, it can't be used with --replay"
+error_invalid_rule = "Invalid table selection rule {0}: {1}"
+error_watch_mode = "--watch can't be used with {0}"
+error_fleet_empty = "No ROMs to analyze in {0}"
+error_fleet_defs = "Fleet statistics need --fleetdefs or --defsrepo"
+error_copy_check_size = "Copy check failed for {0}: size changed from {1} to {2} bytes"
+error_copy_check = "Copy check failed for {0}: {1} ranges differ from the copy plan ({2})"
+error_invalid_expr = "Invalid scaling expression {0}: {1}"
+warning_copy_overlap = "\t\tCopied range {0} overwrites table {1}, which is not copied"
+warning_index_write = "Could not write definitions index {0} ({1})"
+warning_index_memory = "Definitions index of {0} is only kept in memory - the tree is scanned again on each run"
+warning_index_idaddress = "Ignoring invalid internalidaddress {0} in {1}"
+warning_hashes_read = "Could not read table hashes {0} - ignoring them ({1})"
+warning_hashes_write = "Could not write table hashes {0} ({1})"
+warning_verify_mismatch = "\t\tTable {0} differs from the source after copy"
+warning_watch_failed = "\tRefresh failed, waiting for the next change: {0}"
+warning_fleet_size = "\tSkipping {0}: {1} bytes, expected {2}"
+warning_convert_saturated = "\t\tNot converting {0}: {1} values out of range of {2}"
+warning_convert_failed = "\t\tNot converting {0}: {1}"
+error_convert_protected = "it overwrites blacklisted table {0}"
+warning_convert_lossy = "\t\tConverted {0} with precision loss: {1} values, max error {2:g}"
 
 debug_found_common_table = "\t\tFound common table: {0}"
 debug_getting_common_tables_between = "\tGetting common tables between {0} and {1}"
 debug_copying_table = "\tCopying table {0}"
 debug_copy_info = "\t\t\tCopying from addr: {0} size: {1} to addr: {2} size: {3}"
+debug_cache_hit = "\tLoaded definitions for {0} from cache entry {1}"
+debug_cache_miss = "\tNo cache entry for {0} definitions - parsing XMLs"
+debug_cache_evict = "\tEvicting cache entry {0}"
+debug_index_scan = "\tIndexing definition {0}"
+debug_rom_identified = "\tIdentified ROM {0} as {1}, definitions chain: {2}"
+debug_write_back = "\tWriting {0} ranges ({1} bytes) to {2}"
+debug_unknown_scaling = "\tUnknown scaling {0} - assuming {1} bytes"
+debug_converting_table = "\tConverting table {0}"
 
 info_initial_action = "Copying data from ROM {0} to ROM {0}"
 info_step1 = "\tLoading ROMs and Defs..."
 info_step1_finish = "\tFinished load."
 info_step2 = "\tCopying data..."
 info_step3 = "\tDumping to file"
+info_plan = "\tCopy plan: {0} tables in {1} blocks, {2} bytes"
+info_plan_saved = "\tCopy plan saved to {0}"
+info_plan_loaded = "\tCopy plan loaded from {0}"
+info_dry_run = "\tDry run - no ROM is written"
+info_patch_saved = "\tPatch saved to {0}: {1} records, {2} bytes - {3} is not written"
+info_patch_applied = "\t{0} patch {1} on {2}: {3} records"
+info_journal_recovered = "\tRecovered unfinished write of {0} from journal {1}"
+info_batch_start = "Running {0} batch jobs ({1} definition sets) with {2} workers"
+info_batch_job_ok = "\t[{0}] {1} -> {2}: {3} tables, {4} bytes"
+info_batch_job_failed = "\t[{0}] {1} -> {2}: FAILED - {3}"
+info_batch_summary = "Batch finished: {0} ok, {1} failed"
+info_copy_summary = "\tTables: {0} copied, {1} skipped (unchanged), {2} verified"
+info_copy_check = "\tCopy check: {0} blocks match the source, nothing else changed ({1} bytes compared)"
+info_hash_skip = "\tSkipping {0} tables already identical in both ROMs"
+info_checksum = "\tChecksums of {0} (table at {1}): {2} ranges, {3} repaired, {4} verified, {5} invalid"
+info_overlaps = "\tDefinitions of {0}: {1} overlapping spans ({2} shared, {3} conflicting), {4} over blacklisted tables"
+debug_overlap = "\t\tOverlap {0}: {1} {2} / {3} {4}"
+info_conversion = "\tScaling conversion: {0} tables converted ({1} with precision loss), {2} refused (saturated or unconvertible)"
+info_relocation = "\tRelocation check: {0} exact, {1} ambiguous, {2} unverifiable, {3} refused (moved / missing)"
+debug_relocation_refused = "\t\tRefusing table {0}: {1}"
+info_diff = "\tDiff: {0} differing bytes in {1} ranges, {2} tables, {3} bytes in unknown regions"
+info_diff_size = "\tDiff: ROM sizes differ: {0} / {1} bytes"
+info_diff_saved = "\tDiff report saved to {0}"
+info_profile_saved = "\tProfile report saved to {0}"
+info_profile_dump_saved = "\tcProfile statistics saved to {0}"
+info_watch_start = "Watching {0} files every {1}s - Ctrl+C to stop"
+info_watch_change = "\tChanged: {0}"
+info_watch_refresh = "\tRefreshed in {0:.3f}s: {1} tables copied, {2} skipped (unchanged), {3} bytes written"
+info_watch_stop = "Stopped watching"
+info_fleet = "\tFleet: {0} ROMs ({1} skipped), {2} tables, {3} never changed, reference: {4}"
+info_fleet_saved = "\tFleet statistics saved to {0}"
+info_cache_cleared = "\tCleared {0} entries from definitions cache {1}"
+info_index_updated = "\tDefinitions index {0}: {1} files, {2} (re)scanned, {3} removed"
 
 t1D = "1D"
 t2D = "2D"
 t3D = "3D"
 
+# EcuFlash storage type -> (item size, numpy type code)
+storage_types = {
+    "uint8": (1, "u1"),
+    "int8": (1, "i1"),
+    "uint16": (2, "u2"),
+    "int16": (2, "i2"),
+    "uint32": (4, "u4"),
+    "int32": (4, "i4"),
+    "float": (4, "f4"),
+    "bloblist": (4, "u4"),
+}
+default_endian = "big"
+
 table_blacklist = [
     "ECU Identifier",
     "ecu id"
 ]
 
+# Bump whenever the processed table / scaling model changes shape.
+cache_version = 5
+cache_default_dir = os.path.join(os.path.expanduser("~"), ".copyDataFromRomToRom", "cache")
+cache_default_size_mb = 256
+cache_extension = ".defcache"
+
+index_version = 1
+
+plan_version = 1
+
+
+journal_extension = ".journal"
+
+# Relative error above which a converted value is flagged as losing precision.
+conversion_tolerance = 1e-6
+
+# Relocation search: bytes used as window key, and max candidates checked per key.
+relocation_key_size = 8
+relocation_max_candidates = 256
+relocation_filter_bits = 22
+relocation_hash_mul = 0x9E3779B97F4A7C15
+
+reloc_exact = "exact"
+reloc_ambiguous = "ambiguous"
+reloc_unverifiable = "unverifiable"
+reloc_moved = "moved"
+reloc_missing = "missing"
+journal_magic = b"CDRJ"
+patch_magic = b"CDRP"
+patch_version = 1
+
+# Subaru 32-bit checksums: the words of a range plus its checksum add up to this.
+checksum_sum = 0x5AA5A55A
+checksum_entry = struct.Struct(">III")
+checksum_max_entries = 64
+
+# Definition files are hashed in blocks of this size.
+digest_block_size = 1 << 20
+# ROMs are compared in chunks of this size, identical chunks are skipped.
+diff_chunk_size = 1 << 16
+# Copy check failures: differing ranges listed in the error.
+verify_report_ranges = 5
+index_default_name = ".defsindex.json"
+
+watch_default_interval = 1.0
+
+# Fleet statistics: ROMs held in memory at once.
+fleet_chunk_roms = 32
+fleet_default_report = "fleet_stats.npz"
+
+hashes_version = 1
+hashes_extension = ".hashes.json"
+
 
 def myerror(errormsg):
     err = "{0}\n\n{1}".format(errormsg, traceback.format_exc())
@@ -66,12 +273,799 @@ def check(expr, error, *args):
         myerror(error.format(*args))
             
 
+def requireNumpy(feature):
+    if np is None:
+        myerror(error_numpy_missing.format(feature))
+
+
+def debugEnabled():
+    """Check before formatting debug messages in loops."""
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
 def getDictNthKey(adic, n):
     try:
         return list(adic)[n]
     except IndexError:
         return None
 
+"""
+==========================
+    Metrics
+==========================
+"""
+
+class Metrics(object):
+    """Wall time, peak memory and counters of a run (--profile).
+
+    Nothing is measured unless metrics are enabled: instrumentation points
+    check <Metrics.current> first, and <measure> returns an empty context.
+        with Metrics.measure("load"):
+            ...
+        if Metrics.current is not None:
+            Metrics.current.count("tables_parsed", count)
+    Peak memory is traced with tracemalloc: the peak of Python allocations
+    during each phase / file, above what was allocated when it started.
+    Tracing slows the run down, so timings are higher than without metrics.
+    The peak resident size of the process is reported too, where the
+    resource module exists.
+    """
+
+    current = None
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.files = []
+        self.counters = {}
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        # Entries being measured: [base, peak] in bytes, the whole run first
+        self.open = []
+        self.open.append(self._openEntry())
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def maxResident():
+        """Peak resident size of the process, in KB."""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024
+        return peak
+
+    def _fold(self):
+        """Fold the traced peak into the open entries and restart it."""
+        _, peak = tracemalloc.get_traced_memory()
+        for entry in self.open:
+            entry[1] = max(entry[1], peak)
+        tracemalloc.reset_peak()
+
+    def _openEntry(self):
+        self._fold()
+        current, _ = tracemalloc.get_traced_memory()
+        return [current, current]
+
+    def _closeEntry(self, entry):
+        """Peak of an entry above its start, in KB."""
+        self._fold()
+        self.open.remove(entry)
+        return (entry[1] - entry[0]) // 1024
+
+    @contextlib.contextmanager
+    def _measured(self, records, record):
+        start = time.perf_counter()
+        entry = self._openEntry()
+        self.open.append(entry)
+        try:
+            yield
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["peak_kb"] = self._closeEntry(entry)
+            records.append(record)
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def enable():
+        Metrics.current = Metrics()
+        return Metrics.current
+
+    @staticmethod
+    def disable():
+        metrics = Metrics.current
+        Metrics.current = None
+        if metrics is not None and metrics.tracing:
+            tracemalloc.stop()
+        return metrics
+
+    @staticmethod
+    def measure(name):
+        """Context measuring a phase, if metrics are enabled."""
+        if Metrics.current is None:
+            return contextlib.nullcontext()
+        return Metrics.current._measured(Metrics.current.phases, {"name": name})
+
+    @staticmethod
+    def measureFile(flpath):
+        """Context measuring the parse of a definition file, if metrics are enabled."""
+        if Metrics.current is None:
+            return contextlib.nullcontext()
+        return Metrics.current._measured(Metrics.current.files,
+                                         {"path": flpath, "bytes": os.path.getsize(flpath)})
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        if tracemalloc.is_tracing():
+            self._fold()
+        run = self.open[0]
+        return {
+            "seconds": time.perf_counter() - self.started,
+            "peak_kb": (run[1] - run[0]) // 1024,
+            "max_rss_kb": Metrics.maxResident(),
+            "phases": self.phases,
+            "files": self.files,
+            "counters": self.counters
+            }
+
+    def save(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.report(), fp, indent=1)
+
+
+"""
+==========================
+    Table selection
+==========================
+"""
+
+class TableSelection(object):
+    """Which tables are loaded from the definitions.
+
+    Rules are table names, globs, regexes or EcuFlash categories:
+        name:Boost Target   glob:Boost*   re:^(Primary|Secondary) Fuel   category:Fuel
+    A rule without prefix is a glob if it has wildcards, a name otherwise.
+    Rules are case insensitive, regexes match anywhere in the name. The name
+    rules of a list are compiled in one regex. A table is loaded if it
+    matches an include rule (or there are none) and no exclude rule; the
+    table_blacklist entries are always excluded, unless <safety> is False;
+    they are still parsed, to refuse any write over them (see <protects>).
+
+    Selection files have one rule per line: "+rule" to include, "-rule" (or
+    just "rule") to exclude, "#" for comments.
+    """
+
+    def __init__(self, include=(), exclude=(), safety=True):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.safety = safety
+
+        blacklist = ["re:" + re.escape(x) for x in table_blacklist] if safety else []
+        self._include = TableSelection._compile(self.include)
+        self._exclude = TableSelection._compile(self.exclude + blacklist)
+        self._blacklist = TableSelection._compile(blacklist)
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _compile(rules):
+        """Compile rules in (name regex or None, lower case categories)."""
+        patterns = []
+        categories = set()
+        for rule in rules:
+            kind, sep, value = rule.partition(":")
+            if not sep or kind not in ("name", "glob", "re", "category"):
+                kind = "glob" if any(x in rule for x in "*?[") else "name"
+                value = rule
+
+            if kind == "category":
+                categories.add(value.lower())
+            elif kind == "name":
+                patterns.append(re.escape(value) + r"\Z")
+            elif kind == "glob":
+                patterns.append(fnmatch.translate(value))
+            else:
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    myerror(error_invalid_rule.format(rule, e))
+                patterns.append("(?s:.*?(?:{0}))".format(value))
+
+        regex = None
+        if patterns:
+            regex = re.compile("|".join("(?:{0})".format(x) for x in patterns), re.IGNORECASE)
+        return regex, categories
+
+    @staticmethod
+    def _matches(compiled, name, category):
+        regex, categories = compiled
+        if regex is not None and regex.match(name):
+            return True
+        return category is not None and category.lower() in categories
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def fromOptions(include=None, exclude=None, path=None):
+        """Build the selection from the command line rules and a selection file."""
+        include = list(include or [])
+        exclude = list(exclude or [])
+        if path is not None:
+            with open(path, "r") as fp:
+                for line in fp:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.startswith("+"):
+                        include.append(line[1:].strip())
+                    elif line.startswith("-"):
+                        exclude.append(line[1:].strip())
+                    else:
+                        exclude.append(line)
+        return TableSelection(include, exclude)
+
+    def accepts(self, name, category=None):
+        """Check if a table is loaded."""
+        if TableSelection._matches(self._exclude, name, category):
+            return False
+        if self.include:
+            return TableSelection._matches(self._include, name, category)
+        return True
+
+    def protects(self, name):
+        """Check if a table is blacklisted: never copied, and nothing may be copied over it."""
+        return TableSelection._matches(self._blacklist, name, None)
+
+    def key(self):
+        """Identify the selection, for the definitions cache."""
+        return json.dumps([self.include, self.exclude, self.safety])
+
+
+"""
+==========================
+    Definitions cache
+==========================
+"""
+
+class DefsCache(object):
+    """On-disk cache of processed definitions (tables & scalings).
+
+    An entry is keyed by the content hash of every definition file, in the
+    order the files are processed, so any change to a file (or to the set of
+    files) results in a new key. Old entries are evicted, least recently used
+    first, once the cache directory grows over <max_size> bytes.
+    """
+
+    def __init__(self, path=cache_default_dir, max_size=cache_default_size_mb * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+
+    """ =========== Helpers. ============ """
+
+    def _entryPath(self, key):
+        return os.path.join(self.path, key + cache_extension)
+
+    def _entries(self):
+        """List (path, size, last use) of all cache entries."""
+        if not os.path.isdir(self.path):
+            return []
+
+        entries = []
+        for fl in os.listdir(self.path):
+            if fl.endswith(cache_extension):
+                flpath = os.path.join(self.path, fl)
+                try:
+                    st = os.stat(flpath)
+                except OSError:
+                    continue
+                entries.append((flpath, st.st_size, st.st_mtime))
+        return entries
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def computeKey(defs_files, selection="", digests=None):
+        """Compute cache key from an ordered list of (name, path) definition files (and the table selection).
+
+        <digests> (path -> file digest) saves hashing files already hashed.
+        """
+        key = hashlib.blake2b(digest_size=20)
+        key.update(str(cache_version).encode())
+        key.update(selection.encode("utf-8"))
+        for fl, flpath in defs_files:
+            digest = digests[flpath] if digests is not None else RomHelpers.fileDigest(flpath)
+            key.update(fl.lower().encode("utf-8"))
+            key.update(digest.encode())
+        return key.hexdigest()
+
+    def get(self, key):
+        """Retrieve cached object, or None if missing."""
+        flpath = self._entryPath(key)
+        if not os.path.exists(flpath):
+            return None
+
+        try:
+            with open(flpath, "rb") as fp:
+                data = pickle.load(fp)
+            # Mark as recently used, for eviction.
+            os.utime(flpath, None)
+        except Exception as e:
+            logging.warning(error_cache_read.format(flpath, e))
+            return None
+        return data
+
+    def put(self, key, data):
+        """Store object in cache and evict old entries if needed."""
+        flpath = self._entryPath(key)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, flpath)
+        except Exception as e:
+            logging.warning(error_cache_write.format(flpath, e))
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries till cache fits in <max_size>."""
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        total = sum(x[1] for x in entries)
+        debug = debugEnabled()
+        for flpath, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if debug:
+                logging.debug(debug_cache_evict.format(flpath))
+            try:
+                os.remove(flpath)
+            except OSError:
+                continue
+            total -= size
+
+    def invalidate(self, key=None):
+        """Remove one entry, or all of them if no key is given."""
+        if key is not None:
+            targets = [self._entryPath(key)]
+        else:
+            targets = [x[0] for x in self._entries()]
+
+        removed = 0
+        for flpath in targets:
+            if os.path.exists(flpath):
+                os.remove(flpath)
+                removed += 1
+        return removed
+
+
+"""
+==========================
+    Definitions index
+==========================
+"""
+
+class DefsIndex(object):
+    """Index over a full EcuFlash definitions tree.
+
+    Maps every <xmlid> and <internalidstring> to its file and keeps the
+    <include> edges of each file, so the definitions chain of a ROM can be
+    resolved without scanning the tree. Only files that changed since the
+    last run (mtime & size) are re-scanned.
+
+    The index is saved in the tree; if the tree is read-only, it is saved
+    in the cache folder instead (or only kept in memory).
+    """
+
+    def __init__(self, repo_path, index_path=None):
+        self.repo_path = repo_path
+        self.index_path = index_path or os.path.join(repo_path, index_default_name)
+
+        self.files = {}
+        self.by_xmlid = {}
+        self.by_idaddress = {}
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _scanFile(flpath):
+        """Extract romid & includes from the head of a definition file."""
+        info = {"xmlid": None, "internalidaddress": None, "internalidstring": None, "includes": []}
+        for elem in RomHelpers.iterDefElements(flpath):
+            if elem.tag == "romid":
+                for key in ("xmlid", "internalidaddress", "internalidstring"):
+                    text = elem.findtext(key)
+                    if text:
+                        info[key] = text.strip()
+            elif elem.tag == "include":
+                if elem.text:
+                    info["includes"].append(elem.text.strip())
+            elif elem.tag in ("scaling", "table"):
+                # romid & includes always come before the actual data
+                break
+        return info
+
+    def _fallbackPath(self):
+        """Index location in the cache folder, for read-only trees."""
+        key = hashlib.sha1(os.path.abspath(self.repo_path).encode("utf-8")).hexdigest()
+        return os.path.join(cache_default_dir, "defsindex-" + key + ".json")
+
+    def _read(self):
+        if not os.path.exists(self.index_path):
+            fallback = self._fallbackPath()
+            if not os.path.exists(fallback):
+                return
+            self.index_path = fallback
+        try:
+            with open(self.index_path, "r") as fp:
+                data = json.load(fp)
+            if data.get("version") == index_version:
+                self.files = data["files"]
+        except Exception as e:
+            logging.warning(error_index_read.format(self.index_path, e))
+            self.files = {}
+
+    def _write(self):
+        data = {"version": index_version, "files": self.files}
+        paths = [self.index_path]
+        if self.index_path != self._fallbackPath():
+            paths.append(self._fallbackPath())
+
+        for path in paths:
+            try:
+                folder = os.path.dirname(os.path.abspath(path))
+                os.makedirs(folder, exist_ok=True)
+                fd, tmppath = tempfile.mkstemp(dir=folder, suffix=".tmp")
+                with os.fdopen(fd, "w") as fp:
+                    json.dump(data, fp, indent=1, sort_keys=True)
+                os.replace(tmppath, path)
+                self.index_path = path
+                return True
+            except OSError as e:
+                logging.warning(warning_index_write.format(path, e))
+        logging.warning(warning_index_memory.format(self.repo_path))
+        return False
+
+    def _buildLookups(self):
+        """Build the in memory lookup tables."""
+        self.by_xmlid = {}
+        self.by_idaddress = {}
+        for relpath in sorted(self.files):
+            info = self.files[relpath]
+            if info["xmlid"]:
+                self.by_xmlid[info["xmlid"].lower()] = relpath
+            if info["internalidaddress"] and info["internalidstring"]:
+                try:
+                    address = int(info["internalidaddress"], 16)
+                except ValueError:
+                    logging.warning(warning_index_idaddress.format(info["internalidaddress"], relpath))
+                    continue
+                ids = self.by_idaddress.setdefault(address, {})
+                ids[info["internalidstring"].encode("latin-1")] = relpath
+
+    """ =========== Public. ============= """
+
+    def update(self):
+        """Load the index from disk and re-scan only the changed files."""
+        self._read()
+
+        seen = set()
+        scanned = 0
+        debug = debugEnabled()
+        for dirpath, dirnames, filenames in os.walk(self.repo_path):
+            dirnames.sort()
+            for fl in sorted(filenames):
+                if not fl.lower().endswith(".xml"):
+                    continue
+                flpath = os.path.join(dirpath, fl)
+                relpath = os.path.relpath(flpath, self.repo_path)
+                seen.add(relpath)
+
+                st = os.stat(flpath)
+                info = self.files.get(relpath)
+                if info is not None and info["mtime"] == st.st_mtime and info["size"] == st.st_size:
+                    continue
+
+                if debug:
+                    logging.debug(debug_index_scan.format(relpath))
+                info = self._scanFile(flpath)
+                info["mtime"] = st.st_mtime
+                info["size"] = st.st_size
+                self.files[relpath] = info
+                scanned += 1
+
+        removed = [x for x in self.files if x not in seen]
+        for relpath in removed:
+            self.files.pop(relpath)
+
+        if scanned or removed or not os.path.exists(self.index_path):
+            self._write()
+        self._buildLookups()
+
+        logging.info(info_index_updated.format(self.index_path, len(self.files), scanned, len(removed)))
+
+    def getPath(self, xmlid):
+        """Retrieve the path of the definition with the given xmlid."""
+        relpath = self.by_xmlid.get(xmlid.lower(), None)
+        checkNone(relpath, error_unknown_xmlid, xmlid, self.repo_path)
+        return os.path.join(self.repo_path, relpath)
+
+    def identifyRom(self, content):
+        """Retrieve the xmlid of the ROM, based on its internal id string."""
+        for address in sorted(self.by_idaddress):
+            ids = self.by_idaddress[address]
+            for length in sorted(set(len(x) for x in ids), reverse=True):
+                relpath = ids.get(bytes(content[address:address + length]), None)
+                if relpath is not None:
+                    return self.files[relpath]["xmlid"]
+        return None
+
+    def resolveChain(self, xmlid):
+        """Retrieve definition files for xmlid, following includes, base first."""
+        chain = []
+        visiting = []
+
+        def _visit(xid):
+            path = self.getPath(xid)
+            if path in chain:
+                return
+            check(path not in visiting, error_include_loop, xmlid, " -> ".join(visiting + [path]))
+            visiting.append(path)
+
+            info = self.files[os.path.relpath(path, self.repo_path)]
+            for inc in info["includes"]:
+                _visit(inc)
+
+            visiting.pop()
+            chain.append(path)
+
+        _visit(xmlid)
+        return chain
+
+    def resolveRom(self, rom_path):
+        """Identify ROM and retrieve its definition files, base first."""
+        with open(rom_path, "rb") as fp:
+            content = fp.read()
+
+        xmlid = self.identifyRom(content)
+        checkNone(xmlid, error_rom_not_identified, rom_path, self.repo_path)
+
+        chain = self.resolveChain(xmlid)
+        logging.debug(debug_rom_identified.format(rom_path, xmlid, chain))
+        return chain
+
+
+"""
+==========================
+    Table hashes
+==========================
+"""
+
+class TableHashes(object):
+    """Content hash of every table (data & axes) of a ROM.
+
+    Hashes are saved next to the ROM (source ROMs included, the ROM itself is
+    not touched), with the size and modification time of the ROM file. When
+    they still match, the saved hashes are used instead of reading the
+    tables again; a hash is also dropped if the ranges of its table changed
+    in the definitions.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.digests = {}
+        self.computed = False
+
+    """ =========== Helpers. ============ """
+
+    def _path(self):
+        return self.handler.rom_path + hashes_extension
+
+    def _stat(self):
+        st = os.stat(self.handler.rom_path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _compute(self, tname):
+        digest = hashlib.blake2b(digest_size=20)
+        for address, size in self.handler.tables[tname].ranges():
+            digest.update(self.handler.getData(address, size))
+        self.computed = True
+        return digest.hexdigest()
+
+    """ =========== Public. ============= """
+
+    def load(self):
+        """Load the saved hashes, if they are still valid for the ROM file."""
+        path = self._path()
+        if not os.path.exists(path):
+            return self
+
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+            if data.get("version", None) != hashes_version or data["rom"] != self._stat():
+                return self
+            for tname, (ranges, digest) in data["tables"].items():
+                table = self.handler.tables.get(tname, None)
+                if table is not None and [list(x) for x in table.ranges()] == ranges:
+                    self.digests[tname] = digest
+        except Exception as e:
+            logging.warning(warning_hashes_read.format(path, e))
+        return self
+
+    def digest(self, tname):
+        """Retrieve the hash of a table, from the saved ones if possible."""
+        digest = self.digests.get(tname, None)
+        if digest is None:
+            digest = self.digests[tname] = self._compute(tname)
+        return digest
+
+    def forget(self, tnames):
+        """Drop the hashes of tables whose content changed."""
+        for tname in tnames:
+            self.digests.pop(tname, None)
+
+    def verify(self, source, tnames):
+        """Hash <tnames> again and compare them to the <source> hashes. Returns the number of matches."""
+        self.forget(tnames)
+        verified = 0
+        for tname in tnames:
+            if self.digest(tname) == source.digest(tname):
+                verified += 1
+            else:
+                logging.warning(warning_verify_mismatch.format(tname))
+        return verified
+
+    def save(self):
+        """Save the hashes of all tables next to the ROM (only if something changed)."""
+        path = self._path()
+        for tname in self.handler.tables:
+            self.digest(tname)
+        if not self.computed and os.path.exists(path):
+            return
+
+        data = {
+            "version": hashes_version,
+            "rom": self._stat(),
+            "tables": dict((x, [self.handler.tables[x].ranges(), self.digests[x]]) for x in self.handler.tables)
+            }
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(data, fp, separators=(",", ":"))
+            os.replace(tmppath, path)
+        except Exception as e:
+            logging.warning(warning_hashes_write.format(path, e))
+
+    @staticmethod
+    def unchanged(source, dest, tnames):
+        """Retrieve the tables with the same content in both ROMs."""
+        return set(x for x in tnames if source.digest(x) == dest.digest(x))
+
+
+"""
+==========================
+    Address index
+==========================
+"""
+
+class AddressIndex(object):
+    """Sorted interval index over the spans of all tables and axes of a ROM.
+
+    Items are (start, end, tname, axis) tuples, <axis> being None for table
+    data. Spans are sorted by start, and a tree holds the maximum end of
+    every range of them: a query bisects the spans starting before its end,
+    then only descends into the ranges reaching its start. Queries take
+    O(log n) per span found, however long the spans are.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+
+        items = []
+        for tname, table in tables.items():
+            items.append((table.span[0], table.span[1], tname, None))
+            for axis in table.axes:
+                if not axis.static:
+                    items.append((axis.span[0], axis.span[1], tname, axis.name))
+        items.sort()
+
+        self.items = items
+        self.starts = [x[0] for x in items]
+
+        # Implicit binary tree: leaves are the span ends, nodes the max of their children
+        size = 1
+        while size < len(items):
+            size *= 2
+        self.size = size
+        self.max_ends = [-1] * size + [x[1] for x in items] + [-1] * (size - len(items))
+        for node in range(size - 1, 0, -1):
+            self.max_ends[node] = max(self.max_ends[2 * node], self.max_ends[2 * node + 1])
+
+    """ =========== Public. ============= """
+
+    def query(self, start, end):
+        """Retrieve all spans intersecting [start, end)."""
+        found = []
+        count = bisect.bisect_left(self.starts, end)
+        # (node, first span, number of spans), left child popped first to keep them sorted
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, first, width = stack.pop()
+            if first >= count or self.max_ends[node] <= start:
+                continue
+            if node >= self.size:
+                found.append(self.items[node - self.size])
+                continue
+            width //= 2
+            stack.append((2 * node + 1, first + width, width))
+            stack.append((2 * node, first, width))
+        return found
+
+    def lookup(self, address):
+        """Retrieve all spans containing the address."""
+        return self.query(address, address + 1)
+
+    def overlaps(self):
+        """Retrieve (item, other, shared) for every pair of overlapping spans.
+
+        <shared> is True when both spans are identical (typically a shared axis).
+        """
+        found = []
+        active = []
+        for item in self.items:
+            active = [x for x in active if x[1] > item[0]]
+            for other in active:
+                found.append((other, item, other[0] == item[0] and other[1] == item[1]))
+            active.append(item)
+        return found
+
+    def gaps(self, start=0, end=None, min_size=1):
+        """Retrieve (start, end) ranges not covered by any span."""
+        if end is None:
+            end = self.max_ends[1] if self.items else start
+
+        found = []
+        cursor = start
+        for item in self.query(start, end):
+            if item[0] - cursor >= min_size:
+                found.append((cursor, item[0]))
+            cursor = max(cursor, item[1])
+        if end - cursor >= min_size:
+            found.append((cursor, end))
+        return found
+
+    def logOverlaps(self, name, protected=None):
+        """Log overlapping definitions (summary as info, details as debug).
+
+        Spans of the <protected> index (blacklisted tables) overlapping this
+        one are reported apart: copying them would overwrite a blacklisted table.
+        """
+        overlaps = self.overlaps()
+        blacklisted = []
+        if protected is not None:
+            for item in protected.items:
+                for other in self.query(item[0], item[1]):
+                    blacklisted.append((item, other, item[0] == other[0] and item[1] == other[1]))
+
+        shared = len([x for x in overlaps if x[2]])
+        logging.info(info_overlaps.format(name, len(overlaps), shared, len(overlaps) - shared, len(blacklisted)))
+        if not debugEnabled():
+            return overlaps + blacklisted
+        for item, other, is_shared in overlaps:
+            logging.debug(debug_overlap.format("shared" if is_shared else "CONFLICT",
+                                               item[2], item[3] or "", other[2], other[3] or ""))
+        for item, other, _ in blacklisted:
+            logging.debug(debug_overlap.format("BLACKLISTED", item[2], item[3] or "", other[2], other[3] or ""))
+        return overlaps + blacklisted
+
+
 """
 ==========================
     RomHandler 
@@ -84,14 +1078,223 @@ class RomHelpers(object):
     @staticmethod
     def getSizeOfScaling(storagetype):
         """Retrieves size of datatype."""
-        if storagetype == "float":
-            return 4
-        if storagetype == "bloblist":
-            return 4
-        if storagetype == "uint8":
-            return 1
-        if storagetype == "uint16":
-            return 2
+        item = storage_types.get(storagetype.lower(), None)
+        if item is not None:
+            return item[0]
+
+    @staticmethod
+    def fileDigest(flpath, raw=False):
+        """Content hash used to identify definition files and patch bases (read in blocks).
+
+        Hex string, or the 20 bytes of the hash if <raw> is set.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        with open(flpath, "rb") as fp:
+            for block in iter(lambda: fp.read(digest_block_size), b""):
+                digest.update(block)
+        return digest.digest() if raw else digest.hexdigest()
+
+    @staticmethod
+    def iterDefElements(flpath):
+        """Stream the top level elements (scaling, table, ...) of a definition file.
+
+        <flpath> can also be a file object.
+
+        Each element is complete (children included) when yielded, and it is
+        released as soon as the caller moves on, so memory stays bounded by the
+        biggest top level element, not by the whole file.
+        """
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(flpath, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1:
+                yield elem
+                root.clear()
+
+
+"""
+==========================
+    Table model
+==========================
+"""
+
+class DefLayer(object):
+    """Parsed content of one definition file, shared by all RomHandlers.
+
+    Layers are registered by content hash: a file that is byte-identical in
+    several definition folders (32BITBASE.xml for example) is parsed only
+    once per process. A layer only holds raw attributes, it is never changed
+    once parsed; each handler merges its own layers.
+
+    Files are hashed and parsed as streams, but the layers themselves (the
+    attributes of every table and scaling) stay in memory for as long as a
+    handler uses them: that is the cost of sharing them and of reloading only
+    the changed files.
+    """
+
+    __slots__ = ("digest", "scalings", "tables", "__weakref__")
+
+    # content hash -> DefLayer, for as long as a handler uses it
+    registry = weakref.WeakValueDictionary()
+
+    def __init__(self, digest, scalings, tables):
+        self.digest = digest
+        self.scalings = scalings
+        self.tables = tables
+
+    @staticmethod
+    def parse(flpath, digest):
+        """Stream a definition file (path or file object) into a layer."""
+        scalings = []
+        tables = []
+        for elem in RomHelpers.iterDefElements(flpath):
+            if elem.tag == "table":
+                subtables = tuple(dict(x.attrib) for x in elem.findall("table"))
+                tables.append((dict(elem.attrib), subtables))
+            elif elem.tag == "scaling":
+                scalings.append(dict(elem.attrib))
+        return DefLayer(digest, tuple(scalings), tuple(tables))
+
+    @staticmethod
+    def get(flpath):
+        """Retrieve the layer of a definition file, parsing it only if needed."""
+        digest = RomHelpers.fileDigest(flpath)
+
+        layer = DefLayer.registry.get(digest, None)
+        if layer is None:
+            with Metrics.measureFile(flpath):
+                layer = DefLayer.parse(flpath, digest)
+            DefLayer.registry[digest] = layer
+        return layer
+
+
+class RomAxis(object):
+    """Axis (subtable) of a table, with all numbers already parsed."""
+
+    __slots__ = ("name", "address", "elements", "itemsize", "scaling", "static", "size", "span")
+
+    def __init__(self, name, address, elements, itemsize, scaling, static):
+        self.name = name
+        self.address = address
+        self.elements = elements
+        self.itemsize = itemsize
+        self.scaling = scaling
+        self.static = static
+
+        self.size = None
+        self.span = None
+        if not static:
+            self.size = elements * itemsize
+            self.span = (address, address + self.size)
+
+    def signature(self, address_match=True):
+        """Hashable tuple of everything that must match between ROMs."""
+        sig = (self.name, self.elements, self.itemsize, self.scaling, self.static)
+        if address_match:
+            sig += (self.address,)
+        return sig
+
+    def asDict(self):
+        target = {"elements": self.elements}
+        if self.static:
+            target["static"] = True
+        else:
+            target["address"] = hex(self.address)
+            target["itemsize"] = self.itemsize
+            target["scaling"] = self.scaling
+        return target
+
+
+class RomTable(object):
+    """Table definition, with all numbers already parsed.
+
+    <span> is the (start, end) byte range of the data, <axes> holds the
+    RomAxis items in definition order (Y for 2D tables, X and Y for 3D).
+    """
+
+    __slots__ = ("name", "type", "address", "elements", "itemsize", "scaling", "static",
+                 "axes", "size", "span", "sig", "sig_noaddr", "__weakref__")
+
+    # signature -> RomTable, so identical tables are shared between handlers
+    registry = weakref.WeakValueDictionary()
+
+    def __init__(self, name, ttype, address, elements, itemsize, scaling, static, axes):
+        self.name = name
+        self.type = ttype
+        self.address = address
+        self.elements = elements
+        self.itemsize = itemsize
+        self.scaling = scaling
+        self.static = static
+        self.axes = axes
+
+        self.size = elements * itemsize
+        self.span = (address, address + self.size)
+        self._buildSignatures()
+
+    def __eq__(self, other):
+        return isinstance(other, RomTable) and self.sig == other.sig
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.sig)
+
+    def __repr__(self):
+        return "RomTable({0!r}, {1}, {2})".format(self.name, self.type, hex(self.address))
+
+    def _buildSignatures(self):
+        axes = self.axes
+        if axes:
+            axes_sig = tuple([x.signature(False) for x in axes])
+            axes_addr = tuple([x.address for x in axes])
+        else:
+            axes_sig = axes_addr = ()
+        self.sig_noaddr = (self.name, self.type, self.elements, self.itemsize, self.scaling, axes_sig)
+        self.sig = self.sig_noaddr + (self.address, axes_addr)
+
+    def signature(self, address_match=True):
+        """Hashable tuple of everything that must match between ROMs."""
+        if address_match:
+            return self.sig
+        return self.sig_noaddr
+
+    def intern(self):
+        """Retrieve the shared record identical to this one."""
+        table = RomTable.registry.get(self.sig, None)
+        if table is None:
+            RomTable.registry[self.sig] = self
+            table = self
+        return table
+
+    def ranges(self):
+        """List (address, size) of every data block of the table (data & non static axes)."""
+        ranges = [(self.address, self.size)]
+        for axis in self.axes:
+            if not axis.static:
+                ranges.append((axis.address, axis.size))
+        return ranges
+
+    def asDict(self):
+        target = {
+            "type": self.type,
+            "address": hex(self.address),
+            "elements": self.elements,
+            "itemsize": self.itemsize,
+            "scaling": self.scaling,
+            "subt": dict((x.name, x.asDict()) for x in self.axes)
+            }
+        if self.static:
+            target["static"] = True
+        return target
 
 
 class RomsOps(object):
@@ -102,60 +1305,11 @@ class RomsOps(object):
     @staticmethod
     def checkTableMatch(one, other, tname, address_match=True):
         """Check if the table completely matches."""
-        def __tableCheckEQ(o1, o2, path):
-            t1 = o1.tables
-            t2 = o2.tables
-            for x in path:
-                t1 = t1.get(x, None)
-                t2 = t2.get(x, None)
-
-                if t1 is None and t2 is None:
-                    return True
-                if t1 is None or t2 is None:
-                    return False
-
-            if t1 == t2:
-                return True
-            return False
-
-
-        if tname not in other.tables:
-            return False
-        if tname not in one.tables:
-            return False
-        if not __tableCheckEQ(one, other, [tname, "elements"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "itemsize"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "scaling"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "type"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "X", "elements"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "X", "itemsize"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "X", "scaling"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "X", "static"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "Y", "elements"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "Y", "itemsize"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "Y", "scaling"]):
-            return False
-        if not __tableCheckEQ(one, other, [tname, "subt", "Y", "static"]):
+        t1 = one.tables.get(tname, None)
+        t2 = other.tables.get(tname, None)
+        if t1 is None or t2 is None:
             return False
-
-        if address_match:
-            if not __tableCheckEQ(one, other, [tname, "address"]):
-                return False
-            if not __tableCheckEQ(one, other, [tname, "subt", "X", "address"]):
-                return False
-            if not __tableCheckEQ(one, other, [tname, "subt", "Y", "address"]):
-                return False
-        return True
+        return t1.signature(address_match) == t2.signature(address_match)
 
     @staticmethod
     def getCommonTablesWith(one, other, address_match=True):
@@ -165,13 +1319,26 @@ class RomsOps(object):
         if type(one) != RomHandler:
             myerror(error_invalid_type_of_object)
 
+        signatures = set(x.signature(address_match) for x in other.tables.values())
+
         common = []
-        for tname in one.tables:
-            if RomsOps.checkTableMatch(one, other, tname, address_match):
+        for tname, table in one.tables.items():
+            if table.signature(address_match) in signatures:
                 common.append(tname)
 
         return common
 
+    @staticmethod
+    def buildSignatureIndex(roms, address_match=True):
+        """Build inverted index: table signature -> list of ROM indexes having it."""
+        index = {}
+        for idx, rom in enumerate(roms):
+            if type(rom) != RomHandler:
+                myerror(error_invalid_type_of_object)
+            for table in rom.tables.values():
+                index.setdefault(table.signature(address_match), []).append(idx)
+        return index
+
     @staticmethod
     def getCommonTables(roms, address_match=True):
         """Retrieve common tables between the Roms."""
@@ -180,85 +1347,259 @@ class RomsOps(object):
         if len(roms) < 2:
             return []
 
-        common = roms[0] % roms[1]
-        common_set = set(common)
-        for rom in roms[2:]:
-            new_common = rom[0] % rom[2]
-            new_common_set = set(new_common)
+        index = RomsOps.buildSignatureIndex(roms, address_match)
+
+        common = []
+        for tname, table in roms[0].tables.items():
+            if len(index[table.signature(address_match)]) == len(roms):
+                common.append(tname)
+
+        return common
+
+    @staticmethod
+    def getCompatibilityMatrix(roms, address_match=True):
+        """Retrieve matrix with the number of common tables for each pair of Roms.
+
+        matrix[i][j] is the number of tables that can be copied between roms[i]
+        and roms[j]; the diagonal holds the number of tables of each Rom.
+        """
+        if type(roms) != type([]):
+            myerror(error_inpropper_argument.format(type(roms)))
 
-            common_set = common_set.intersection(new_common_set)
+        matrix = [[0] * len(roms) for _ in roms]
+        for owners in RomsOps.buildSignatureIndex(roms, address_match).values():
+            for i in owners:
+                row = matrix[i]
+                for j in owners:
+                    row[j] += 1
 
-        return list(common_set)
+        return matrix
 
     @staticmethod
     def getOffsetsPairsForTable(source, dest, tname):
         """Retrieve all offsets and sizes for a table, in pairs."""
-        def _buildSet(offsets, ts, td):
-            setx = (
-                int(ts["address"], 16),
-                int(ts["elements"]) * int(ts["itemsize"]),
-                int(td["address"], 16),
-                int(td["elements"]) * int(td["itemsize"])
-                )
-            offsets.append(setx)
+        ranges_s = source.tables[tname].ranges()
+        ranges_d = dest.tables[tname].ranges()
 
         offsets = []
+        for rs, rd in zip(ranges_s, ranges_d):
+            offsets.append((rs[0], rs[1], rd[0], rd[1]))
+        return offsets
 
-        ts = source.tables[tname]
-        td = dest.tables[tname]
-        _buildSet(offsets, ts, td)
+    @staticmethod
+    def copyRomData(source, dest, address_match):
+        """Copy rOM data from source to destionation."""
+        plan = CopyPlan.build(source, dest, address_match)
+        before = bytes(dest.content)
+        plan.apply(source, dest)
+        plan.verify(source, dest, before)
+        return plan
+
+
+"""
+==========================
+    Copy plan
+==========================
+"""
 
-        if source.tables[tname]["type"] != t1D:
-            ts = source.tables[tname]["subt"]
-            ts = ts[getDictNthKey(ts, 0)]
-            td = dest.tables[tname]["subt"]
-            td = td[getDictNthKey(td, 0)]
+class CopyPlan(object):
+    """Ordered list of merged (src, dst, size) block copies between two ROMs.
 
-            if 'static' not in ts:
-                _buildSet(offsets, ts, td)
+    Ranges of the common tables are sorted by destination and adjacent (or
+    identical, like shared axes) ranges are merged in as few blocks as
+    possible. A plan does not need any definition to be applied, so it can
+    be saved and replayed on other ROMs with the same layout.
+    """
 
-        if source.tables[tname]["type"] == t3D:
-            ts = source.tables[tname]["subt"]
-            ts = ts[getDictNthKey(ts, 1)]
-            td = dest.tables[tname]["subt"]
-            td = td[getDictNthKey(td, 1)]
-            _buildSet(offsets, ts, td)
+    def __init__(self, blocks, address_match=True, source_size=None, dest_size=None):
+        self.blocks = blocks
+        self.address_match = address_match
+        self.source_size = source_size
+        self.dest_size = dest_size
 
-        return offsets               
+    """ =========== Helpers. ============ """
 
     @staticmethod
-    def copyRomData(source, dest, address_match):
-        """Copy rOM data from source to destionation."""
-        common_tables = RomsOps.getCommonTablesWith(source, dest, address_match)
+    def _mergeRanges(entries):
+        """Merge sorted (dst, src, size, tname) entries in blocks."""
+        blocks = []
+        for dst, src, size, tname in entries:
+            if blocks:
+                last = blocks[-1]
+                last_end = last[1] + last[2]
+                same_delta = (dst - src) == (last[1] - last[0])
+                if dst < last_end:
+                    check(same_delta, error_plan_overlap, hex(dst), ", ".join(last[3]), tname)
+                if dst <= last_end and same_delta:
+                    last[2] = max(last_end, dst + size) - last[1]
+                    if tname not in last[3]:
+                        last[3].append(tname)
+                    continue
+            blocks.append([src, dst, size, [tname]])
+        return blocks
+
+    def _checkSize(self, what, expected, rom):
+        if expected is not None:
+            check(len(rom.content) == expected, error_plan_rom_size, what, expected, len(rom.content))
 
-        for tname in common_tables:
-            logging.debug(debug_copying_table.format(tname))
+    """ =========== Public. ============= """
 
-            offsets = RomsOps.getOffsetsPairsForTable(source, dest, tname)
+    @staticmethod
+    def build(source, dest, address_match=True, tables=None, skip=()):
+        """Build the copy plan for the common tables of two ROMs (or only for <tables>).
+
+        Tables in <skip> (already identical) are left out of the plan.
+        """
+        if tables is None:
+            tables = RomsOps.getCommonTablesWith(source, dest, address_match)
+
+        debug = debugEnabled()
+        entries = []
+        for tname in tables:
+            if tname in skip:
+                continue
+            if debug:
+                logging.debug(debug_copying_table.format(tname))
+            for items in RomsOps.getOffsetsPairsForTable(source, dest, tname):
+                check(items[1] == items[3], error_plan_size_mismatch, tname, items[1], items[3])
+                if items[1]:
+                    entries.append((items[2], items[0], items[1], tname))
+        entries.sort()
+        blocks = CopyPlan._mergeRanges(entries)
+
+        # Writes over blacklisted tables are refused, writes over other tables which are not copied
+        # (bad definitions, left out of the selection) only reported
+        copied = set(tables)
+        index = dest.getAddressIndex()
+        protected = dest.getProtectedIndex()
+        for src, dst, size, tnames in blocks:
+            for item in protected.query(dst, dst + size):
+                myerror(error_plan_protected.format(hex(dst), size, ", ".join(tnames), item[2]))
+            for item in index.query(dst, dst + size):
+                if item[2] not in copied:
+                    logging.warning(warning_copy_overlap.format(hex(dst), item[2]))
+
+        content_s = getattr(source, "content", None)
+        content_d = getattr(dest, "content", None)
+        return CopyPlan(
+            blocks,
+            address_match,
+            len(content_s) if content_s is not None else None,
+            len(content_d) if content_d is not None else None)
 
-            for items in offsets:
-                logging.debug(debug_copy_info.format(
-                    hex(items[0]),
-                    items[1],
-                    hex(items[2]),
-                    items[3]))
-                data = source.getData(items[0], items[1])
-                dest.setData(items[2], items[3], data)
+    @staticmethod
+    def load(path):
+        """Load a copy plan saved with <save>."""
+        with open(path, "r") as fp:
+            data = json.load(fp)
+        check(data.get("version", None) == plan_version, error_plan_version, path)
+        return CopyPlan(data["blocks"], data["address_match"], data["source_size"], data["dest_size"])
+
+    def save(self, path):
+        """Save copy plan as JSON."""
+        data = {
+            "version": plan_version,
+            "address_match": self.address_match,
+            "source_size": self.source_size,
+            "dest_size": self.dest_size,
+            "blocks": self.blocks
+            }
+        with open(path, "w") as fp:
+            json.dump(data, fp, separators=(",", ":"))
+
+    def tableCount(self):
+        return len(set(tname for x in self.blocks for tname in x[3]))
+
+    def byteCount(self):
+        return sum(x[2] for x in self.blocks)
+
+    def describe(self):
+        """Human readable plan, one line per block."""
+        lines = [info_plan.format(self.tableCount(), len(self.blocks), self.byteCount())]
+        for src, dst, size, tnames in self.blocks:
+            lines.append("\t\t{0} -> {1} size: {2} tables: {3}".format(hex(src), hex(dst), size, ", ".join(tnames)))
+        return "\n".join(lines)
+
+    def apply(self, source, dest):
+        """Copy all blocks from source ROM to destination ROM."""
+        self._checkSize("source", self.source_size, source)
+        self._checkSize("destination", self.dest_size, dest)
+
+        debug = debugEnabled()
+        for src, dst, size, _ in self.blocks:
+            if debug:
+                logging.debug(debug_copy_info.format(hex(src), size, hex(dst), size))
+            dest.setData(dst, size, source.getData(src, size))
+
+        if Metrics.current is not None:
+            Metrics.current.count("ranges_copied", len(self.blocks))
+            Metrics.current.count("bytes_copied", self.byteCount())
+
+    def verify(self, source, dest, before):
+        """Check the destination right after <apply>, against its content <before> it.
+
+        The expected image (<before> with every block copied from the source)
+        is compared to the destination in one pass: the size must be the same,
+        every block must hold the source bytes and nothing else may have
+        changed. Returns the number of bytes compared.
+        """
+        content = dest.content
+        check(len(content) == len(before), error_copy_check_size, dest.rom_path, len(before), len(content))
+
+        expected = bytearray(before)
+        for src, dst, size, _ in self.blocks:
+            expected[dst:dst + size] = source.getData(src, size)
+
+        ranges = RomDiff.compare(expected, content)
+        if ranges:
+            blocks = sorted((x[1], x[1] + x[2]) for x in self.blocks)
+            starts = [x[0] for x in blocks]
+            details = []
+            for start, end in ranges[:verify_report_ranges]:
+                idx = bisect.bisect_right(starts, start) - 1
+                planned = idx >= 0 and start < blocks[idx][1]
+                details.append("{0}-{1} {2}".format(hex(start), hex(end), "in a block" if planned else "outside the plan"))
+            myerror(error_copy_check.format(dest.rom_path, len(ranges), ", ".join(details)))
+        return len(content)
 
 
 class RomHandler(object):
-    """Generic container for handleling a ROM file, including definitions."""
+    """Generic container for handleling a ROM file, including definitions.
+
+    <defs_path> is either a folder with all the definitions of the ROM, or a
+    list of definition files (as resolved by <DefsIndex>), base first.
+    Only the tables accepted by <selection> are loaded (by default, all but
+    the blacklisted ones). Blacklisted tables are kept apart, in <protected>,
+    so that copies over them can be refused.
+
+    The ROM is memory mapped: read-only for a source ROM, copy-on-write for a
+    destination ROM, whose changed ranges are the only ones written back.
+    With <mapped> False (see <unmapRom>), it is read in memory instead, so the
+    file can be replaced while the handler is kept.
+    """
 
-    def __init__(self, rom_path, defs_path):
+    def __init__(self, rom_path, defs_path, cache=None, readonly=False, selection=None):
         self.rom_path = rom_path
         self.defs_path = defs_path
+        self.cache = cache
+        self.readonly = readonly
+        self.selection = selection if selection is not None else TableSelection()
+        self.excluded = set()
+        self.protected = {}
+
+        self.content = None
+        self.mapped = True
+        self.dirty = []
 
         self.defs = []
         self.tables = {}
         self.scalings = {}
+        self.address_index = None
+        self.protected_index = None
 
     def __str__(self):
-        return pprint.pformat(self.tables, indent=4)
+        tables = dict((x, self.tables[x].asDict()) for x in self.tables)
+        return pprint.pformat(tables, indent=4)
 
     def __mod__(self, other):
         return RomsOps.getCommonTablesWith(self, other)
@@ -285,20 +1626,29 @@ class RomHandler(object):
 
     """ =========== Private. ============ """
 
-    def _loadDefs(self):
-        """Load definitions as XML tree objects."""
+    def _listDefs(self):
+        """List (name, path) of the definition files, in processing order."""
+        if isinstance(self.defs_path, (list, tuple)):
+            return [(os.path.basename(x), x) for x in self.defs_path]
+
+        defs_files = []
         for fl in os.listdir(self.defs_path):
             if fl.endswith(".xml"):
-                flpath = os.path.join(self.defs_path, fl)
+                defs_files.append((fl, os.path.join(self.defs_path, fl)))
+        return defs_files
 
-                root = ET.parse(flpath).getroot()
-                self.defs.append((fl, root))
+    def _loadDefs(self):
+        """Load definitions as parsed layers.
+
+        The layers are shared with all other handlers using the same files, and
+        kept in <defs> for the life of the handler, so they stay shared.
+        """
+        self.defs = [(fl, DefLayer.get(flpath)) for fl, flpath in self._listDefs()]
 
     def _loadScalings(self):
         """Load table scalings."""
-        for xml in self.defs:
-            xml = xml[1]
-            for scalingtag in xml.findall("scaling"):
+        for fl, layer in self.defs:
+            for scalingtag in layer.scalings:
                 name = scalingtag.get("name", None)
                 storagetype = scalingtag.get("storagetype", None)
 
@@ -307,13 +1657,17 @@ class RomHandler(object):
                 #check(name not in self.scalings, error_scaling_memorisez, name)
 
                 itemsize = RomHelpers.getSizeOfScaling(storagetype)
-                self.scalings[name] = {"type":storagetype, "itemsize":itemsize}
+                endian = scalingtag.get("endian", default_endian).lower()
+                self.scalings[name] = {"type":storagetype.lower(), "itemsize":itemsize, "endian":endian,
+                                       "toexpr":scalingtag.get("toexpr", "x"), "frexpr":scalingtag.get("frexpr", "x")}
 
-    def _processScaling(self, target):
+    def _processScaling(self, target, debug=False):
         if "scaling" in target:
             if target["scaling"] in self.scalings:
                 target["itemsize"] = self.scalings[target["scaling"]]["itemsize"]
             else:
+                if debug:
+                    logging.debug(debug_unknown_scaling.format(target["scaling"], 4))
                 target["itemsize"] = 4
 
     def _process2D(self, ttag, name, subtables):
@@ -326,7 +1680,6 @@ class RomHandler(object):
         self._addToTargetTable(self.tables[name]["subt"], "Y", subt_xml, "scaling")
 
         target = self.tables[name]["subt"]["Y"]
-        self._processScaling(target)
 
         if "static" in ttype:
             target["static"] = True
@@ -351,7 +1704,6 @@ class RomHandler(object):
         self._addToTargetTable(self.tables[name]["subt"], "X", subt_1_xml, "scaling")
 
         targetX = self.tables[name]["subt"]["X"]
-        self._processScaling(targetX)
         x_size = int(targetX.get("elements", "1"), 10)
 
         # Y
@@ -360,7 +1712,6 @@ class RomHandler(object):
         self._addToTargetTable(self.tables[name]["subt"], "Y", subt_2_xml, "scaling")
 
         targetY = self.tables[name]["subt"]["Y"]
-        self._processScaling(targetY)
         y_size = int(targetY.get("elements", "1"), 10)
 
         # Correction on possible missing data
@@ -374,12 +1725,12 @@ class RomHandler(object):
             x_size = int(targetX["elements"], 10)
             corrected = True
 
-        if corrected:
+        if corrected and debugEnabled():
             logging.debug("Correcting table {0}".format(name))
 
         return x_size, y_size
 
-    def _processSubtables(self, ttag, name):
+    def _processSubtables(self, ttag, name, subtables):
         """Extract subtable data."""
         x_size = 1
         y_size = 1
@@ -387,7 +1738,6 @@ class RomHandler(object):
         # Setup
         if "subt" not in self.tables[name]:
             self.tables[name]["subt"] = {}
-        subtables = ttag.findall("table")
 
         # Processing the table
         target = self.tables[name]["type"]
@@ -425,6 +1775,8 @@ class RomHandler(object):
                 delete = True
             if "type" not in self.tables[tname]:
                 delete = True
+            if self.tables[tname].get("itemsize", None) is None:
+                delete = True
 
             if "subt" in self.tables[tname]:
                 target = self.tables[tname]["subt"]
@@ -434,20 +1786,23 @@ class RomHandler(object):
                             delete = True
                         if "elements" not in target[item]:
                             delete = True
+                        if target[item].get("itemsize", None) is None:
+                            delete = True
 
             if delete:
                 to_delete.append(tname)
 
-        for tname in self.tables:
-            for black in table_blacklist:
-                if black.lower() in tname.lower():
-                    to_delete.append(tname)
-
-        logging.debug("Cleaning up tables for {0}".format(self.rom_path))
+        debug = debugEnabled()
+        if debug:
+            logging.debug("Cleaning up tables for {0}".format(self.rom_path))
         for item in to_delete:
-            logging.debug("\tRemoving table {0}".format(item))
+            if debug:
+                logging.debug("\tRemoving table {0}".format(item))
             self.tables.pop(item, None)
 
+        if Metrics.current is not None:
+            Metrics.current.count("tables_dropped", len(to_delete))
+
     def _correctTables(self):
         """Do correction operations on tables that do not respect common format.""" 
         for tname in self.tables:
@@ -462,48 +1817,188 @@ class RomHandler(object):
                 sz = self.tables[tname]["subt"][key]["elements"]
                 self.tables[tname]["elements"] = int(sz)
 
-    def _processTableFromDef(self, defroot):
-        """Process a definition to load into memory."""
-        for ttag in defroot.findall("table"):
-            name = ttag.get("name")
+    def _processTableFromDef(self, ttag, subtables):
+        """Process a table definition to load into memory."""
+        name = ttag.get("name")
+        if name in self.excluded:
+            return
+        if name not in self.tables or "category" in ttag:
+            if not self.selection.accepts(name, ttag.get("category", None)) and not self.selection.protects(name):
+                self.tables.pop(name, None)
+                self.excluded.add(name)
+                return
+
+        self._addToTable(name, ttag, "type")
+        self._addToTable(name, ttag, "scaling")
+        self._addToTable(name, ttag, "address")
+
+        if "type" in self.tables[name]:
+            self._processSubtables(ttag, name, subtables)
+
+    def _resolveScalings(self):
+        """Set item sizes, once all the scalings are known."""
+        debug = debugEnabled()
+        for tname in self.tables:
+            self._processScaling(self.tables[tname], debug)
+            for item in self.tables[tname].get("subt", {}).values():
+                self._processScaling(item, debug)
 
-            if "Feedback Correction" in name:
-                i = 1
+    def _orderedDefs(self):
+        """Indexes of <defs>, in table processing order: base (bitbase) first."""
+        ordered = [idx for idx, x in enumerate(self.defs) if "bitbase" in x[0].lower()]
+        ordered += [idx for idx, x in enumerate(self.defs) if "bitbase" not in x[0].lower()]
+        return ordered
 
-            self._addToTable(name, ttag, "type")
-            self._addToTable(name, ttag, "scaling")
-            self._addToTable(name, ttag, "address")
-            
-            target = self.tables[name]
-            self._processScaling(target)
+    def _applyLayer(self, layer):
+        """Process all tables of a definition layer."""
+        for ttag, subtables in layer.tables:
+            self._processTableFromDef(ttag, subtables)
 
-            if "type" in target:
-                self._processSubtables(ttag, name)
+        if Metrics.current is not None:
+            Metrics.current.count("tables_parsed", len(layer.tables))
 
     def _loadTables(self):
         """Load tables into memory."""
+        for idx in self._orderedDefs():
+            self._applyLayer(self.defs[idx][1])
 
-        for xml in self.defs:
-            if "bitbase" in xml[0].lower():
-                self._processTableFromDef(xml[1])
-
-        for xml in self.defs:
-            if "bitbase" not in xml[0].lower():
-                self._processTableFromDef(xml[1])            
+        self._finishTables()
 
+    def _finishTables(self):
+        """Fixups & typed model, once all the layers are processed."""
+        self._resolveScalings()
         self._cleanupTables()
         self._correctTables()
+        self._buildModel()
+
+        # Blacklisted tables are only kept to refuse copies over them
+        self.protected = dict((x, self.tables.pop(x)) for x in sorted(self.tables) if self.selection.protects(x))
+        if Metrics.current is not None:
+            Metrics.current.count("tables_excluded", len(self.excluded) + len(self.protected))
+
+    def _buildModel(self):
+        """Replace the parsed table dicts with typed RomTable records."""
+        tables = {}
+        for tname, target in self.tables.items():
+            axes = []
+            for aname, subt in target.get("subt", {}).items():
+                static = "static" in subt
+                address = None
+                if "address" in subt:
+                    address = int(subt["address"], 16)
+                axes.append(RomAxis(aname, address, int(subt.get("elements", 1)),
+                                    subt.get("itemsize", None), subt.get("scaling", None), static))
+
+            tables[tname] = RomTable(
+                tname,
+                target["type"],
+                int(target["address"], 16),
+                int(target["elements"]),
+                target["itemsize"],
+                target.get("scaling", None),
+                "static" in target,
+                tuple(axes)).intern()
+        self.tables = tables
+
+    def _cacheLookup(self, digests=None):
+        """Load tables & scalings from cache. Returns (cache key, found)."""
+        if self.cache is None:
+            return None, False
+
+        key = DefsCache.computeKey(self._listDefs(), self.selection.key(), digests)
+        data = self.cache.get(key)
+        if data is None:
+            logging.debug(debug_cache_miss.format(self.rom_path))
+            if Metrics.current is not None:
+                Metrics.current.count("cache_misses")
+            return key, False
+
+        if Metrics.current is not None:
+            Metrics.current.count("cache_hits")
+        logging.debug(debug_cache_hit.format(self.rom_path, key))
+        self.scalings, tables, protected = data
+        self.tables = dict((x, tables[x].intern()) for x in tables)
+        self.protected = dict((x, protected[x].intern()) for x in protected)
+        return key, True
+
+    def _cacheStore(self, key):
+        if key is not None:
+            self.cache.put(key, (self.scalings, self.tables, self.protected))
+
+    def reloadDefinitions(self):
+        """Load the definitions again, after a file changed. Returns the names of the changed tables.
+
+        Only the changed files are parsed, the others are the layers kept in <defs>.
+        """
+        old = self.tables
+        self.tables = {}
+        self.scalings = {}
+        self.excluded = set()
 
-    """ =========== Public. ============= """
+        self._loadDefs()
+        self._loadScalings()
+        self._loadTables()
 
-    def load(self):
-        """Load data (rom & defs) into memory."""
-        with open(self.rom_path, "rb") as fp:
-            self.content = bytearray(fp.read())
+        changed = set(x for x in self.tables if old.get(x, None) != self.tables[x])
+        return changed | (set(old) - set(self.tables))
+
+    def loadDefinitions(self):
+        """Load processed tables & scalings, from cache if possible."""
+        key, found = self._cacheLookup()
+        if found:
+            return
 
         self._loadDefs()
         self._loadScalings()
         self._loadTables()
+        self._cacheStore(key)
+
+    """ =========== Public. ============= """
+
+    def load(self):
+        """Load data (rom & defs) into memory."""
+        self.loadRom()
+        self.loadDefinitions()
+
+    def loadRom(self):
+        """Map (or read) the ROM data (no definitions)."""
+        journal_path = self.rom_path + journal_extension
+        if os.path.exists(journal_path):
+            if self.readonly:
+                logging.warning(warning_pending_journal.format(self.rom_path, journal_path))
+            else:
+                RomHandler._applyJournal(self.rom_path, journal_path)
+                logging.info(info_journal_recovered.format(self.rom_path, journal_path))
+
+        self.dirty = []
+        with open(self.rom_path, "rb") as fp:
+            if not self.mapped or os.fstat(fp.fileno()).st_size == 0:
+                # Kept in memory on request (see unmapRom); empty files can't be mapped anyway
+                self.content = bytearray(fp.read())
+            elif self.readonly:
+                self.content = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.content = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def unmapRom(self):
+        """Keep the ROM data in memory and release the file mapping, now and on the next loads."""
+        self.mapped = False
+        if isinstance(self.content, mmap.mmap):
+            content = bytearray(self.content)
+            self.content.close()
+            self.content = content
+
+    def getAddressIndex(self):
+        """Retrieve the address index of the tables, (re)built if the tables changed."""
+        if self.address_index is None or self.address_index.tables is not self.tables:
+            self.address_index = AddressIndex(self.tables)
+        return self.address_index
+
+    def getProtectedIndex(self):
+        """Retrieve the address index of the blacklisted tables."""
+        if self.protected_index is None or self.protected_index.tables is not self.protected:
+            self.protected_index = AddressIndex(self.protected)
+        return self.protected_index
 
     def getData(self, offset, size):
         """Retrieve binary data."""
@@ -511,12 +2006,1485 @@ class RomHandler(object):
 
     def setData(self, offset, size, data):
         """Set binary data."""
+        if self.readonly:
+            myerror(error_readonly_rom.format(self.rom_path))
+        if len(data) != size:
+            myerror(error_set_data_size.format(self.rom_path, hex(offset), size, len(data)))
+
         self.content[offset:(offset+size)] = data
+        self.dirty.append((offset, offset + size))
+
+    def dirtyRanges(self):
+        """Retrieve the merged (start, end) ranges changed since load."""
+        merged = []
+        for start, end in sorted(self.dirty):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(x) for x in merged]
+
+    @staticmethod
+    def _writeJournal(journal_path, records):
+        """Write (offset, data) records to a journal, atomically."""
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(journal_path)), suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(journal_magic)
+            fp.write(struct.pack(">I", len(records)))
+            for offset, data in records:
+                fp.write(struct.pack(">QI", offset, len(data)))
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmppath, journal_path)
+
+    @staticmethod
+    def _applyJournal(rom_path, journal_path):
+        """Write all journal records in the ROM file, then drop the journal."""
+        with open(journal_path, "rb") as fp:
+            check(fp.read(4) == journal_magic, error_invalid_journal, journal_path)
+            count = struct.unpack(">I", fp.read(4))[0]
+            records = []
+            for _ in range(count):
+                offset, length = struct.unpack(">QI", fp.read(12))
+                data = fp.read(length)
+                check(len(data) == length, error_invalid_journal, journal_path)
+                records.append((offset, data))
+
+        with open(rom_path, "r+b") as fp:
+            for offset, data in records:
+                fp.seek(offset)
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.remove(journal_path)
 
     def dumpToFile(self):
-        """Dump ROM to file."""
-        with open(self.rom_path, "wb") as fp:
-            fp.write(self.content)
+        """Write the changed ranges of the ROM back to file.
+
+        The ranges go first in a journal next to the ROM, so an interrupted
+        write is finished on the next load instead of leaving a half written ROM.
+        """
+        check(not self.readonly, error_readonly_rom, self.rom_path)
+
+        ranges = self.dirtyRanges()
+        if not ranges:
+            return
+
+        records = [(start, bytes(self.content[start:end])) for start, end in ranges]
+        logging.debug(debug_write_back.format(len(records), sum(len(x[1]) for x in records), self.rom_path))
+        if Metrics.current is not None:
+            Metrics.current.count("bytes_written", sum(len(x[1]) for x in records))
+
+        journal_path = self.rom_path + journal_extension
+        RomHandler._writeJournal(journal_path, records)
+        RomHandler._applyJournal(self.rom_path, journal_path)
+        self.dirty = []
+
+
+"""
+==========================
+    Binary patch
+==========================
+"""
+
+class RomPatch(object):
+    """Changes made to a ROM, saved as a binary patch instead of a new ROM image.
+
+    File layout (big endian):
+        header  - magic, version, ROM size, base ROM digest, patched ROM digest, record count
+        record  - offset, size, size of names, table names (utf-8, one per line), old bytes, new bytes
+    The old bytes are kept, so a patch can be reverted. A patch is only
+    written on the ROM it was made for (checked with the digest), through
+    the write journal.
+    """
+
+    header = struct.Struct(">4sHI20s20sI")
+    record = struct.Struct(">IIH")
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def export(handler, path):
+        """Save the changes of a ROM (not written to file yet) as patch. Returns (records, bytes)."""
+        ranges = handler.dirtyRanges()
+        index = handler.getAddressIndex()
+        base = RomHelpers.fileDigest(handler.rom_path, raw=True)
+        result = hashlib.blake2b(handler.content, digest_size=20).digest()
+
+        size = 0
+        with open(handler.rom_path, "rb") as original, open(path, "wb") as fp:
+            fp.write(RomPatch.header.pack(patch_magic, patch_version, len(handler.content), base, result, len(ranges)))
+            for start, end in ranges:
+                tnames = []
+                for item in index.query(start, end):
+                    if item[2] not in tnames:
+                        tnames.append(item[2])
+                names = "\n".join(tnames).encode("utf-8")
+                original.seek(start)
+                fp.write(RomPatch.record.pack(start, end - start, len(names)))
+                fp.write(names)
+                fp.write(original.read(end - start))
+                fp.write(handler.content[start:end])
+                size += end - start
+        return len(ranges), size
+
+    @staticmethod
+    def apply(path, rom_path, revert=False):
+        """Write a patch on a ROM (or take it back). Returns the number of records."""
+        with open(path, "rb") as fp:
+            data = fp.read(RomPatch.header.size)
+            check(len(data) == RomPatch.header.size, error_invalid_patch, path)
+            magic, version, rom_size, base, result, count = RomPatch.header.unpack(data)
+            check(magic == patch_magic and version == patch_version, error_invalid_patch, path)
+
+            expected, target = (result, base) if revert else (base, result)
+            check(os.path.getsize(rom_path) == rom_size, error_patch_base, rom_path, path, "size")
+            check(RomHelpers.fileDigest(rom_path, raw=True) == expected, error_patch_base, rom_path, path, "digest")
+
+            records = []
+            for _ in range(count):
+                data = fp.read(RomPatch.record.size)
+                check(len(data) == RomPatch.record.size, error_invalid_patch, path)
+                offset, size, names_size = RomPatch.record.unpack(data)
+                fp.seek(names_size, os.SEEK_CUR)
+                old = fp.read(size)
+                new = fp.read(size)
+                check(len(new) == size, error_invalid_patch, path)
+                records.append((offset, old if revert else new))
+
+        journal_path = rom_path + journal_extension
+        RomHandler._writeJournal(journal_path, records)
+        RomHandler._applyJournal(rom_path, journal_path)
+        check(RomHelpers.fileDigest(rom_path, raw=True) == target, error_patch_result, rom_path, path)
+        return count
+
+
+"""
+==========================
+    Checksums
+==========================
+"""
+
+class SubaruChecksum(object):
+    """Checksum table of 32-bit Subaru ROMs.
+
+    The table is a list of big endian (start, end, checksum) entries: the
+    32-bit words of [start, end) plus the checksum must add up to
+    0x5AA5A55A. Unused entries are (0, 0, 0x5AA5A55A), which is how the table
+    is found when its address is not given: the entries around the unused
+    ones are followed while they look valid.
+    """
+
+    def __init__(self, handler, address=None):
+        requireNumpy("Checksum")
+        self.handler = handler
+        if address is None:
+            address = SubaruChecksum.locate(handler.content)
+            checkNone(address, error_checksum_not_found, handler.rom_path)
+        self.address = address
+        self.entries = self._readEntries()
+        check(self.entries, error_checksum_table, hex(address), handler.rom_path)
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _kind(content, offset):
+        """Kind of the entry at offset: "used", "unused" or None (not a checksum entry)."""
+        if offset < 0 or offset + checksum_entry.size > len(content):
+            return None
+        start, end, checksum = checksum_entry.unpack_from(content, offset)
+        if start == 0 and end == 0 and checksum == checksum_sum:
+            return "unused"
+        if start < end <= len(content) and not start % 4 and not end % 4:
+            return "used"
+        return None
+
+    def _readEntries(self):
+        """List (entry offset, start, end, checksum) of the used entries."""
+        entries = []
+        content = self.handler.content
+        offset = self.address
+        for _ in range(checksum_max_entries):
+            kind = SubaruChecksum._kind(content, offset)
+            if kind is None:
+                break
+            if kind == "used":
+                entries.append((offset,) + checksum_entry.unpack_from(content, offset))
+            offset += checksum_entry.size
+        return entries
+
+    def _sum(self, start, end):
+        words = np.frombuffer(self.handler.content, dtype=">u4", count=(end - start) // 4, offset=start)
+        return int(words.sum(dtype=np.uint64)) & 0xFFFFFFFF
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def locate(content):
+        """Find the address of the checksum table, or None."""
+        count = len(content) // 4
+        if count < 3:
+            return None
+        words = np.frombuffer(content, dtype=">u4", count=count)
+        unused = np.flatnonzero((words[:-2] == 0) & (words[1:-1] == 0) & (words[2:] == checksum_sum)) * 4
+
+        best = None
+        seen = set()
+        for offset in unused.tolist():
+            # Walk back to the first entry of the table
+            start = offset
+            while start - offset < checksum_max_entries * checksum_entry.size and \
+                    SubaruChecksum._kind(content, start - checksum_entry.size) is not None:
+                start -= checksum_entry.size
+            if start in seen:
+                continue
+            seen.add(start)
+
+            used = 0
+            position = start
+            for _ in range(checksum_max_entries):
+                kind = SubaruChecksum._kind(content, position)
+                if kind is None:
+                    break
+                used += kind == "used"
+                position += checksum_entry.size
+            if used and (best is None or used >= best[0]):
+                best = (used, start)
+        return best[1] if best is not None else None
+
+    def touched(self, ranges):
+        """Indexes of the entries touching the (start, end) ranges."""
+        return [idx for idx, (_, start, end, _) in enumerate(self.entries)
+                if any(x < end and y > start for x, y in ranges)]
+
+    def verify(self, indexes=None):
+        """Check the ranges of the given entries (default: all of them).
+        Returns list of {"address", "start", "end", "stored", "expected", "ok"}."""
+        if indexes is None:
+            indexes = range(len(self.entries))
+        results = []
+        for idx in indexes:
+            offset, start, end, checksum = self.entries[idx]
+            expected = (checksum_sum - self._sum(start, end)) & 0xFFFFFFFF
+            results.append({"address": offset, "start": start, "end": end,
+                            "stored": checksum, "expected": expected, "ok": checksum == expected})
+        return results
+
+    def repair(self, ranges):
+        """Recompute the checksums of the entries touching the (start, end) ranges. Returns the number fixed."""
+        repaired = 0
+        for idx in self.touched(ranges):
+            offset, start, end, checksum = self.entries[idx]
+            expected = (checksum_sum - self._sum(start, end)) & 0xFFFFFFFF
+            if expected != checksum:
+                self.handler.setData(offset + 8, 4, struct.pack(">I", expected))
+                self.entries[idx] = (offset, start, end, expected)
+                repaired += 1
+        return repaired
+
+    @staticmethod
+    def fix(handler, address=None, full_verify=False):
+        """Repair the checksums touched by the changes of a ROM and log the result.
+
+        Only the repaired entries are verified again, unless <full_verify> is set.
+        """
+        checksums = SubaruChecksum(handler, address)
+        ranges = handler.dirtyRanges()
+        repaired = checksums.repair(ranges)
+        results = checksums.verify(None if full_verify else checksums.touched(ranges))
+        invalid = [x for x in results if not x["ok"]]
+        for item in invalid:
+            logging.warning(warning_checksum_invalid.format(hex(item["start"]), hex(item["end"])))
+        logging.info(info_checksum.format(handler.rom_path, hex(checksums.address), len(checksums.entries),
+                                          repaired, len(results), len(invalid)))
+        return repaired, len(invalid)
+
+
+"""
+==========================
+    Table relocation
+==========================
+"""
+
+class RelocationEngine(object):
+    """Check that tables matched without address (--nomatch) are really the same data.
+
+    The axes of a table are usually the same between ROM versions, even when
+    the table moved. The bytes of every source axis are searched in the
+    destination ROM (or in a window around the address of the destination
+    definition) in one vectorized pass: every window of the ROM gets a key
+    made of its first bytes, all keys are matched against all axes at once,
+    and only the candidates are compared in full.
+
+    Each table gets a confidence:
+        exact        - all axes found at the destination address, and only there
+        ambiguous    - all axes found at the destination address, but also elsewhere
+        unverifiable - no axis to search for (1D tables, static axes)
+        moved        - an axis is only found at other addresses
+        missing      - an axis is not found at all
+    Moved and missing tables are refused.
+    """
+
+    def __init__(self, source, dest, window=None):
+        requireNumpy("Relocation check")
+        self.source = source
+        self.dest = dest
+        self.window = window
+
+    """ =========== Helpers. ============ """
+
+    def _fingerprints(self, tnames):
+        """List (tname, axis name, axis bytes, destination address) of searchable axes."""
+        fingerprints = []
+        for tname in tnames:
+            ts = self.source.tables[tname]
+            td = self.dest.tables[tname]
+            for axs, axd in zip(ts.axes, td.axes):
+                if axs.static or not axs.size:
+                    continue
+                data = bytes(self.source.getData(axs.address, axs.size))
+                fingerprints.append((tname, axs.name, data, axd.address))
+        return fingerprints
+
+    def _windowKeys(self, rom, size):
+        """Big endian key of the first <size> bytes of every window of the ROM."""
+        count = len(rom) - size + 1
+        keys = np.zeros(max(count, 0), dtype=np.uint64)
+        if count <= 0:
+            return keys
+        for j in range(size):
+            keys <<= np.uint64(8)
+            keys |= rom[j:j + count]
+        return keys
+
+    def _search(self, fingerprints):
+        """Find all addresses of every fingerprint. Returns list of address lists."""
+        rom = np.frombuffer(self.dest.content, dtype=np.uint8)
+        content = self.dest.content
+        found = [[] for _ in fingerprints]
+
+        # Group by key size, short axes get shorter keys
+        groups = {}
+        for idx, fp in enumerate(fingerprints):
+            size = min(relocation_key_size, len(fp[2]))
+            key = int.from_bytes(fp[2][:size], "big")
+            groups.setdefault(size, {}).setdefault(key, []).append(idx)
+
+        for size, by_key in groups.items():
+            keys = self._windowKeys(rom, size)
+            wanted = np.array(sorted(by_key), dtype=np.uint64)
+
+            # Cheap prefilter on a hash of the keys, then exact lookup of the
+            # remaining windows in the sorted array of wanted keys
+            shift = np.uint64(64 - relocation_filter_bits)
+            bitmap = np.zeros(1 << relocation_filter_bits, dtype=bool)
+            mul = np.uint64(relocation_hash_mul)
+            bitmap[(wanted * mul) >> shift] = True
+            hits = np.flatnonzero(bitmap[(keys * mul) >> shift])
+
+            slots = np.searchsorted(wanted, keys[hits])
+            np.minimum(slots, len(wanted) - 1, out=slots)
+            matched = wanted[slots] == keys[hits]
+            hits = hits[matched]
+            if not len(hits):
+                continue
+
+            hit_slots = slots[matched]
+            order = np.argsort(hit_slots, kind="stable")
+            hits = hits[order]
+            hit_slots = hit_slots[order]
+            uniq, starts = np.unique(hit_slots, return_index=True)
+            ends = starts.tolist()[1:] + [len(hits)]
+
+            for slot, start, end in zip(uniq.tolist(), starts.tolist(), ends):
+                key = int(wanted[slot])
+                positions = hits[start:end]
+                for idx in by_key[key]:
+                    _, _, data, expected = fingerprints[idx]
+                    candidates = positions
+                    if self.window is not None:
+                        candidates = candidates[np.abs(candidates.astype(np.int64) - expected) <= self.window]
+                    if len(candidates) > relocation_max_candidates:
+                        # Keep the expected address, even past the limit
+                        at_expected = bool(np.any(candidates == expected))
+                        candidates = candidates[:relocation_max_candidates].tolist()
+                        if at_expected and expected not in candidates:
+                            candidates.append(expected)
+                    else:
+                        candidates = candidates.tolist()
+                    length = len(data)
+                    found[idx] = [x for x in candidates if content[x:x + length] == data]
+        return found
+
+    """ =========== Public. ============= """
+
+    def run(self, tnames):
+        """Check tables. Returns dict tname -> {"confidence", "score", "axes"}."""
+        fingerprints = self._fingerprints(tnames)
+        found = self._search(fingerprints)
+
+        report = dict((x, {"confidence": reloc_unverifiable, "score": None, "axes": []}) for x in tnames)
+        for (tname, aname, _, expected), addresses in zip(fingerprints, found):
+            report[tname]["axes"].append({"name": aname, "expected": expected, "found": addresses})
+
+        for tname, item in report.items():
+            if not item["axes"]:
+                continue
+
+            score = 0.0
+            confidence = reloc_exact
+            for axis in item["axes"]:
+                if not axis["found"]:
+                    confidence = reloc_missing
+                elif axis["expected"] not in axis["found"]:
+                    if confidence != reloc_missing:
+                        confidence = reloc_moved
+                else:
+                    score += 1.0 / len(axis["found"])
+                    if len(axis["found"]) > 1 and confidence == reloc_exact:
+                        confidence = reloc_ambiguous
+            item["confidence"] = confidence
+            item["score"] = score / len(item["axes"])
+
+        return report
+
+    @staticmethod
+    def accepted(report):
+        """Retrieve the tables that can be copied, in report order."""
+        refused = (reloc_moved, reloc_missing)
+        debug = debugEnabled()
+        tables = []
+        for tname, item in report.items():
+            if item["confidence"] in refused:
+                if debug:
+                    logging.debug(debug_relocation_refused.format(tname, item["confidence"]))
+            else:
+                tables.append(tname)
+        return tables
+
+    @staticmethod
+    def summary(report):
+        counts = dict((x, 0) for x in (reloc_exact, reloc_ambiguous, reloc_unverifiable, reloc_moved, reloc_missing))
+        for item in report.values():
+            counts[item["confidence"]] += 1
+        return info_relocation.format(counts[reloc_exact], counts[reloc_ambiguous], counts[reloc_unverifiable],
+                                      counts[reloc_moved] + counts[reloc_missing])
+
+
+"""
+==========================
+    ROM diff
+==========================
+"""
+
+class RomDiff(object):
+    """Differing byte ranges between two ROMs, attributed to tables and axes.
+
+    Both ROMs are compared at the same offsets, chunk by chunk: identical
+    chunks are skipped with a plain buffer compare, the others are compared
+    byte by byte (vectorized when numpy is available). Each differing range
+    is split over the spans of the address index of both ROMs; what is not
+    covered by any table or axis is reported as unknown.
+    """
+
+    def __init__(self, source, dest, chunk=diff_chunk_size):
+        self.source = source
+        self.dest = dest
+        self.chunk = chunk
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _chunkRanges(a, b, base):
+        """Differing (start, end) ranges of two chunks of the same size."""
+        if np is not None:
+            idx = np.flatnonzero(np.frombuffer(a, dtype=np.uint8) != np.frombuffer(b, dtype=np.uint8))
+            breaks = np.flatnonzero(np.diff(idx) != 1)
+            starts = [int(idx[0])] + idx[breaks + 1].tolist()
+            ends = idx[breaks].tolist() + [int(idx[-1])]
+            return [(base + x, base + y + 1) for x, y in zip(starts, ends)]
+
+        ranges = []
+        start = None
+        for idx in range(len(a)):
+            if a[idx] != b[idx]:
+                if start is None:
+                    start = idx
+            elif start is not None:
+                ranges.append((base + start, base + idx))
+                start = None
+        if start is not None:
+            ranges.append((base + start, base + len(a)))
+        return ranges
+
+    @staticmethod
+    def _append(ranges, start, end):
+        """Append a range, merging it with the last one if they touch."""
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def compare(content_s, content_d, chunk=diff_chunk_size):
+        """Sorted (start, end) differing ranges of two buffers. The tail of the longer one counts as different."""
+        size = min(len(content_s), len(content_d))
+
+        ranges = []
+        for base in range(0, size, chunk):
+            a = content_s[base:base + chunk]
+            b = content_d[base:base + chunk]
+            if a == b:
+                continue
+            for start, end in RomDiff._chunkRanges(a, b, base):
+                RomDiff._append(ranges, start, end)
+
+        longest = max(len(content_s), len(content_d))
+        if longest > size:
+            RomDiff._append(ranges, size, longest)
+        return ranges
+
+    def ranges(self):
+        """Sorted (start, end) differing ranges of the ROMs."""
+        return RomDiff.compare(self.source.content, self.dest.content, self.chunk)
+
+    def run(self):
+        """Compare the ROMs. Returns the report as dict."""
+        ranges = self.ranges()
+        indexes = [self.source.getAddressIndex(), self.dest.getAddressIndex()]
+
+        tables = {}
+        unknown = []
+        for start, end in ranges:
+            parts = set()
+            for index in indexes:
+                for item in index.query(start, end):
+                    parts.add((max(start, item[0]), min(end, item[1]), item[2], item[3]))
+
+            for lo, hi, tname, axis in sorted(parts):
+                entry = tables.setdefault(tname, {"bytes": 0, "parts": {}, "ranges": []})
+                part = axis or "data"
+                entry["bytes"] += hi - lo
+                entry["parts"][part] = entry["parts"].get(part, 0) + hi - lo
+                entry["ranges"].append([lo, hi, part])
+
+            cursor = start
+            for lo, hi, _, _ in sorted(parts):
+                if lo > cursor:
+                    unknown.append([cursor, lo])
+                cursor = max(cursor, hi)
+            if end > cursor:
+                unknown.append([cursor, end])
+
+        return {
+            "source_rom": self.source.rom_path,
+            "dest_rom": self.dest.rom_path,
+            "source_size": len(self.source.content),
+            "dest_size": len(self.dest.content),
+            "bytes": sum(x[1] - x[0] for x in ranges),
+            "ranges": [list(x) for x in ranges],
+            "tables": tables,
+            "unknown": unknown,
+            "unknown_bytes": sum(x[1] - x[0] for x in unknown)
+            }
+
+    @staticmethod
+    def summary(report):
+        return info_diff.format(report["bytes"], len(report["ranges"]), len(report["tables"]), report["unknown_bytes"])
+
+    @staticmethod
+    def describe(report):
+        """Human readable report: one line per table, then the unknown regions."""
+        lines = [RomDiff.summary(report)]
+        if report["source_size"] != report["dest_size"]:
+            lines.append(info_diff_size.format(report["source_size"], report["dest_size"]))
+        for tname in sorted(report["tables"], key=lambda x: report["tables"][x]["ranges"][0][0]):
+            entry = report["tables"][tname]
+            parts = ", ".join("{0}: {1}".format(x, y) for x, y in sorted(entry["parts"].items()))
+            lines.append("\t\t{0} at {1}: {2} bytes ({3})".format(
+                tname, hex(entry["ranges"][0][0]), entry["bytes"], parts))
+        for start, end in report["unknown"]:
+            lines.append("\t\tunknown {0} -> {1} size: {2}".format(hex(start), hex(end), end - start))
+        return "\n".join(lines)
+
+
+"""
+==========================
+    Table decoding
+==========================
+"""
+
+class TableDecoder(object):
+    """Decode / encode table data of a ROM as numpy arrays.
+
+    Arrays are views over the ROM buffer (no copy), with the type and byte
+    order of the table scaling. 3D tables are shaped (Y, X). Arrays of a
+    writable ROM must not be changed in place: use <encode>, so the change
+    is tracked for write-back.
+    """
+
+    def __init__(self, handler):
+        requireNumpy("Table decoding")
+        self.handler = handler
+        self._dtypes = {}
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def dtypeFor(storagetype, endian=default_endian, itemsize=4):
+        """Retrieve numpy dtype for an EcuFlash storage type."""
+        order = "<" if endian == "little" else ">"
+        item = storage_types.get(storagetype, None) if storagetype else None
+        if item is None:
+            # Unknown storage: raw unsigned items of the given size
+            return np.dtype("{0}u{1}".format(order, itemsize))
+        return np.dtype(order + item[1])
+
+    def dtype(self, item):
+        """Retrieve numpy dtype of a RomTable / RomAxis."""
+        key = (item.scaling, item.itemsize)
+        dtype = self._dtypes.get(key, None)
+        if dtype is None:
+            scaling = self.handler.scalings.get(item.scaling, None)
+            if scaling is None:
+                dtype = TableDecoder.dtypeFor(None, default_endian, item.itemsize)
+            else:
+                dtype = TableDecoder.dtypeFor(scaling["type"], scaling["endian"], item.itemsize)
+            self._dtypes[key] = dtype
+        return dtype
+
+    def _item(self, tname, axis=None):
+        table = self.handler.tables[tname]
+        if axis is None:
+            return table
+        for x in table.axes:
+            if x.name == axis:
+                check(not x.static, error_static_axis, axis, tname)
+                return x
+        raise KeyError(axis)
+
+    def _shape(self, table):
+        if table.type == t3D and len(table.axes) == 2:
+            return (table.axes[1].elements, table.axes[0].elements)
+        return (table.elements,)
+
+    """ =========== Public. ============= """
+
+    def decode(self, tname, axis=None):
+        """Retrieve data (or <axis> data) of a table as an array view."""
+        item = self._item(tname, axis)
+        array = np.frombuffer(self.handler.content, dtype=self.dtype(item),
+                              count=item.elements, offset=item.address)
+        if axis is None:
+            array = array.reshape(self._shape(item))
+        return array
+
+    def decodeTable(self, tname):
+        """Retrieve dict with "data" and every non static axis of a table."""
+        decoded = {"data": self.decode(tname)}
+        for axis in self.handler.tables[tname].axes:
+            if not axis.static:
+                decoded[axis.name] = self.decode(tname, axis.name)
+        return decoded
+
+    def decodeAll(self, tnames=None):
+        """Decode many tables. Returns dict tname -> <decodeTable> result."""
+        if tnames is None:
+            tnames = list(self.handler.tables)
+        return dict((x, self.decodeTable(x)) for x in tnames)
+
+    def encode(self, tname, values, axis=None):
+        """Write values in a table (or <axis>), converted to its storage type."""
+        item = self._item(tname, axis)
+        values = np.asarray(values)
+        check(values.size == item.elements, error_encode_size, values.size, axis or "data", tname, item.elements)
+
+        data = values.astype(self.dtype(item), copy=False).tobytes()
+        self.handler.setData(item.address, len(data), data)
+
+
+"""
+==========================
+    Scaling conversion
+==========================
+"""
+
+class ScalingExpr(object):
+    """EcuFlash scaling expression (toexpr / frexpr), compiled once, applied on arrays.
+
+    Only arithmetic on <x>, numbers and a few math functions are accepted.
+    """
+
+    _nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load, ast.Call,
+              ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+    _functions = ("exp", "log", "log10", "sqrt", "abs")
+
+    # expression -> ScalingExpr
+    compiled = {}
+
+    def __init__(self, expr):
+        self.expr = expr
+        # EcuFlash uses ^ for power
+        try:
+            tree = ast.parse(expr.replace("^", "**"), mode="eval")
+        except SyntaxError as e:
+            myerror(error_invalid_expr.format(expr, e.msg))
+        for node in ast.walk(tree):
+            check(isinstance(node, ScalingExpr._nodes), error_invalid_expr, expr, type(node).__name__)
+            if isinstance(node, ast.Constant):
+                check(type(node.value) in (int, float), error_invalid_expr, expr, repr(node.value))
+            if isinstance(node, ast.Name):
+                check(node.id == "x" or node.id in ScalingExpr._functions, error_invalid_expr, expr, node.id)
+            if isinstance(node, ast.Call):
+                check(isinstance(node.func, ast.Name) and node.func.id in ScalingExpr._functions,
+                      error_invalid_expr, expr, "call")
+        self.code = compile(tree, "<scaling>", "eval")
+
+    def __call__(self, x):
+        env = dict((name, getattr(np, name)) for name in ScalingExpr._functions)
+        env["x"] = x
+        # Division by zero & co. give inf / nan, counted as saturated by the caller
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            return np.asarray(eval(self.code, {"__builtins__": {}}, env), dtype=np.float64) * np.ones_like(x)
+
+    @staticmethod
+    def get(expr):
+        """Retrieve compiled expression."""
+        item = ScalingExpr.compiled.get(expr, None)
+        if item is None:
+            item = ScalingExpr(expr)
+            ScalingExpr.compiled[expr] = item
+        return item
+
+
+class TableConverter(object):
+    """Copy tables whose scaling (storage type, size or expressions) changed.
+
+    Tables with the same name, type, element counts and (if needed)
+    addresses, but not an exact match, are converted: source values go
+    through the source toexpr, then through the destination frexpr and
+    storage type, a whole table (or axis) at a time. Values out of range of
+    the new storage type refuse the table, as do expressions that can't be
+    evaluated and spans over blacklisted tables; values that don't survive
+    the round trip are flagged as precision loss.
+    """
+
+    def __init__(self, source, dest, address_match=True):
+        requireNumpy("Scaling conversion")
+        self.source = source
+        self.dest = dest
+        self.address_match = address_match
+
+        self.decoder_s = TableDecoder(source)
+        self.decoder_d = TableDecoder(dest)
+        self.converted = {}
+        self.common = None
+
+    """ =========== Helpers. ============ """
+
+    def _convertSignature(self, table):
+        sig = (table.name, table.type, table.elements, tuple((x.name, x.elements, x.static) for x in table.axes))
+        if self.address_match:
+            sig += (table.address, tuple(x.address for x in table.axes))
+        return sig
+
+    def _scaling(self, handler, item):
+        return handler.scalings.get(item.scaling, None)
+
+    def _commonTables(self):
+        if self.common is None:
+            self.common = set(RomsOps.getCommonTablesWith(self.source, self.dest, self.address_match))
+        return self.common
+
+    def _checkSpans(self, table, copied):
+        """Refuse writes over blacklisted tables (returns the reason), report writes over tables which are not copied."""
+        protected = self.dest.getProtectedIndex()
+        index = self.dest.getAddressIndex()
+        for address, size in table.ranges():
+            for item in protected.query(address, address + size):
+                return error_convert_protected.format(item[2])
+            for item in index.query(address, address + size):
+                if item[2] not in copied:
+                    logging.warning(warning_copy_overlap.format(hex(address), item[2]))
+        return None
+
+    def _convertPart(self, tname, axis, item_s, item_d):
+        """Convert data (or an axis). Returns (values, saturated, lossy, max error)."""
+        raw = self.decoder_s.decode(tname, axis).astype(np.float64).ravel()
+        scaling_s = self._scaling(self.source, item_s)
+        scaling_d = self._scaling(self.dest, item_d)
+        dtype = self.decoder_d.dtype(item_d)
+
+        if scaling_s == scaling_d and item_s.itemsize == item_d.itemsize:
+            return raw.astype(dtype), 0, 0, 0.0
+
+        to_s = ScalingExpr.get(scaling_s["toexpr"] if scaling_s else "x")
+        to_d = ScalingExpr.get(scaling_d["toexpr"] if scaling_d else "x")
+        fr_d = ScalingExpr.get(scaling_d["frexpr"] if scaling_d else "x")
+
+        physical = to_s(raw)
+        stored = fr_d(physical)
+        if dtype.kind in "iu":
+            stored = np.rint(stored)
+            info = np.iinfo(dtype)
+        else:
+            info = np.finfo(dtype)
+        saturated = int(np.count_nonzero(~np.isfinite(stored) | (stored < info.min) | (stored > info.max)))
+
+        values = np.clip(np.nan_to_num(stored), info.min, info.max).astype(dtype)
+        with np.errstate(invalid="ignore"):
+            error = np.abs(to_d(values.astype(np.float64)) - physical)
+        lossy = error > conversion_tolerance * np.maximum(1.0, np.abs(physical))
+        max_error = float(error.max()) if error.size else 0.0
+        return values, saturated, int(np.count_nonzero(lossy)), max_error
+
+    """ =========== Public. ============= """
+
+    def candidates(self):
+        """Retrieve tables that are not an exact match, but can be converted."""
+        common = self._commonTables()
+        tables = []
+        for tname, table in self.source.tables.items():
+            other = self.dest.tables.get(tname, None)
+            if tname in common or other is None:
+                continue
+            if self._convertSignature(table) != self._convertSignature(other):
+                continue
+            scalings = [self._scaling(h, x) for h, t in ((self.source, table), (self.dest, other))
+                        for x in (t,) + tuple(y for y in t.axes if not y.static)]
+            if any(x is not None and x["type"] == "bloblist" for x in scalings):
+                continue
+            tables.append(tname)
+        return tables
+
+    def run(self, tnames=None):
+        """Convert tables (without writing them). Returns dict tname -> report."""
+        if tnames is None:
+            tnames = self.candidates()
+
+        copied = self._commonTables() | set(tnames)
+        debug = debugEnabled()
+        report = {}
+        self.converted = {}
+        for tname in tnames:
+            if debug:
+                logging.debug(debug_converting_table.format(tname))
+            ts = self.source.tables[tname]
+            td = self.dest.tables[tname]
+
+            parts = [(None, ts, td)]
+            parts += [(xs.name, xs, xd) for xs, xd in zip(ts.axes, td.axes) if not xs.static]
+
+            item = {"saturated": 0, "lossy": 0, "max_error": 0.0, "error": self._checkSpans(td, copied)}
+            report[tname] = item
+
+            values = []
+            if item["error"] is None:
+                try:
+                    for axis, item_s, item_d in parts:
+                        converted, saturated, lossy, max_error = self._convertPart(tname, axis, item_s, item_d)
+                        values.append((axis, converted))
+                        item["saturated"] += saturated
+                        item["lossy"] += lossy
+                        item["max_error"] = max(item["max_error"], max_error)
+                except (RuntimeError, TypeError, ValueError, ArithmeticError) as e:
+                    item["error"] = str(e).splitlines()[0]
+
+            if item["error"] is not None:
+                logging.warning(warning_convert_failed.format(tname, item["error"]))
+                continue
+            if item["saturated"]:
+                logging.warning(warning_convert_saturated.format(tname, item["saturated"], td.scaling))
+                continue
+            if item["lossy"]:
+                logging.warning(warning_convert_lossy.format(tname, item["lossy"], item["max_error"]))
+            self.converted[tname] = values
+
+        return report
+
+    def apply(self):
+        """Write the converted tables to the destination ROM."""
+        for tname, values in self.converted.items():
+            for axis, converted in values:
+                self.decoder_d.encode(tname, converted, axis)
+
+    @staticmethod
+    def summary(report):
+        refused = len([x for x in report.values() if x["saturated"] or x["error"] is not None])
+        lossy = len([x for x in report.values() if x["lossy"] and not x["saturated"] and x["error"] is None])
+        return info_conversion.format(len(report) - refused, lossy, refused)
+
+
+"""
+==========================
+    Fleet statistics
+==========================
+"""
+
+class FleetStats(object):
+    """Value statistics of every table over many ROMs sharing one definitions set.
+
+    The definitions are loaded once (by <handler>, whose ROM is the stock
+    ROM if there is one). The ROMs are read <chunk> at a time in one
+    (ROMs x bytes) array, each table being a slice of its columns, so the
+    memory used does not depend on the number of ROMs.
+
+    Per table: identical data are grouped in variants, variant 0 being the
+    stock data (or the most common one without stock ROM); changed rate is
+    the share of ROMs not on variant 0. Min / max / mean are over the raw
+    stored values, per element and per table.
+    """
+
+    def __init__(self, handler, rom_paths, stock=None, chunk=fleet_chunk_roms):
+        requireNumpy("Fleet statistics")
+        self.handler = handler
+        self.rom_paths = rom_paths
+        self.stock = stock
+        self.chunk = chunk
+        self.decoder = TableDecoder(handler)
+        self.tables = [x for x in sorted(handler.tables) if handler.tables[x].size]
+
+    """ =========== Helpers. ============ """
+
+    def _readChunk(self, paths, size):
+        """Stack the ROMs of a chunk. Returns (array, paths used)."""
+        data = np.empty((len(paths), size), dtype=np.uint8)
+        used = []
+        for path in paths:
+            with open(path, "rb") as fp:
+                actual = os.fstat(fp.fileno()).st_size
+                if actual != size:
+                    logging.warning(warning_fleet_size.format(path, actual, size))
+                    continue
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                    data[len(used)] = np.frombuffer(content, dtype=np.uint8)
+            used.append(path)
+        return data[:len(used)], used
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def listRoms(path):
+        """ROMs of a folder (all files), or of a text file with one path per line."""
+        if os.path.isdir(path):
+            return sorted(os.path.join(path, x) for x in os.listdir(path)
+                          if os.path.isfile(os.path.join(path, x)) and not x.endswith(hashes_extension))
+        base = os.path.dirname(os.path.abspath(path))
+        with open(path, "r") as fp:
+            return [os.path.normpath(os.path.join(base, x.strip())) for x in fp if x.strip()]
+
+    @staticmethod
+    def referenceRom(rom_paths):
+        """First ROM having the most common size (the one to load the definitions with, without stock ROM)."""
+        sizes = [os.path.getsize(x) for x in rom_paths]
+        common = max(set(sizes), key=sizes.count)
+        return rom_paths[sizes.index(common)]
+
+    def run(self):
+        """Compute the statistics. Returns dict of arrays (columns)."""
+        size = len(self.handler.content)
+        items = [self.handler.tables[x] for x in self.tables]
+        dtypes = [self.decoder.dtype(x) for x in items]
+        counts = [x.size // x.itemsize for x in items]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        total = int(offsets[-1])
+        element_min = np.full(total, np.inf)
+        element_max = np.full(total, -np.inf)
+        element_sum = np.zeros(total)
+        element_count = np.zeros(total, dtype=np.int64)
+
+        variants = [{} for _ in items]
+        if self.stock is not None:
+            for idx, item in enumerate(items):
+                variants[idx][bytes(self.handler.getData(item.address, item.size))] = 0
+
+        used = []
+        labels = []
+        for start in range(0, len(self.rom_paths), self.chunk):
+            data, paths = self._readChunk(self.rom_paths[start:start + self.chunk], size)
+            if not paths:
+                continue
+            used += paths
+            chunk_labels = np.empty((len(items), len(paths)), dtype=np.int32)
+
+            for idx, item in enumerate(items):
+                raw = np.ascontiguousarray(data[:, item.address:item.address + item.size])
+                uniq, inverse = np.unique(raw, axis=0, return_inverse=True)
+                ids = np.array([variants[idx].setdefault(x.tobytes(), len(variants[idx])) for x in uniq],
+                               dtype=np.int32)
+                chunk_labels[idx] = ids[inverse.reshape(-1)]
+
+                values = raw.view(dtypes[idx]).astype(np.float64)
+                finite = np.isfinite(values)
+                part = slice(offsets[idx], offsets[idx + 1])
+                element_min[part] = np.minimum(element_min[part], np.where(finite, values, np.inf).min(axis=0))
+                element_max[part] = np.maximum(element_max[part], np.where(finite, values, -np.inf).max(axis=0))
+                element_sum[part] += np.where(finite, values, 0.0).sum(axis=0)
+                element_count[part] += finite.sum(axis=0)
+            labels.append(chunk_labels)
+
+        check(used, error_fleet_empty, ", ".join(self.rom_paths[:3]))
+        labels = np.concatenate(labels, axis=1)
+
+        if self.stock is None:
+            # Most common variant becomes variant 0
+            for idx in range(len(items)):
+                frequency = np.bincount(labels[idx], minlength=len(variants[idx]))
+                order = np.argsort(-frequency, kind="stable")
+                remap = np.empty_like(order)
+                remap[order] = np.arange(len(order))
+                labels[idx] = remap[labels[idx]]
+
+        top_share = np.array([np.bincount(x).max() for x in labels]) / float(len(used))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            element_mean = element_sum / element_count
+            table_count = np.add.reduceat(element_count, offsets[:-1])
+            table_mean = np.add.reduceat(element_sum, offsets[:-1]) / table_count
+        table_min = np.minimum.reduceat(element_min, offsets[:-1])
+        table_max = np.maximum.reduceat(element_max, offsets[:-1])
+
+        return {
+            "roms": np.array(used),
+            "skipped": np.array([x for x in self.rom_paths if x not in set(used)]),
+            "reference": np.array(self.stock or ""),
+            "tables": np.array(self.tables),
+            "changed_rate": (labels != 0).mean(axis=1),
+            "variants": np.array([len(np.unique(x)) for x in labels], dtype=np.int32),
+            "top_variant_share": top_share,
+            "min": table_min,
+            "max": table_max,
+            "mean": table_mean,
+            "element_offset": offsets,
+            "element_min": element_min,
+            "element_max": element_max,
+            "element_mean": element_mean,
+            "labels": labels
+            }
+
+    @staticmethod
+    def save(stats, path):
+        """Save as compressed numpy columns (load with numpy.load)."""
+        with open(path, "wb") as fp:
+            np.savez_compressed(fp, **stats)
+
+    @staticmethod
+    def summary(stats):
+        """One line summary."""
+        never = int(np.sum(stats["changed_rate"] == 0))
+        return info_fleet.format(len(stats["roms"]), len(stats["skipped"]), len(stats["tables"]), never,
+                                 str(stats["reference"]) or "most common")
+
+
+"""
+==========================
+    Load pipeline
+==========================
+"""
+
+class LoadPipeline(object):
+    """Load several RomHandlers (ROMs & definitions) concurrently.
+
+    ROM files and definition hashes are read in a thread pool, while the
+    distinct definition files are parsed once each, in the calling thread.
+    Each handler applies its layers as soon as they are ready, in the usual
+    order (bitbase first).
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _advance(state, layers):
+        """Apply the ready layers of a handler, in order. Returns True when done."""
+        handler, key, digests, order, pos = state
+        while pos < len(order) and digests[order[pos]] in layers:
+            handler._applyLayer(layers[digests[order[pos]]])
+            pos += 1
+        state[4] = pos
+
+        if pos < len(order):
+            return False
+
+        handler._loadScalings()
+        handler._finishTables()
+        handler._cacheStore(key)
+        return True
+
+    """ =========== Public. ============= """
+
+    def run(self):
+        """Load all handlers."""
+        with concurrent.futures.ThreadPoolExecutor(max(2, len(self.handlers) * 2)) as io_pool:
+            roms = [io_pool.submit(x.loadRom) for x in self.handlers if x.rom_path is not None]
+
+            # Each file is hashed once, for the cache keys and the layers
+            handler_files = [x._listDefs() for x in self.handlers]
+            paths = set(flpath for files in handler_files for _, flpath in files)
+            digests = dict((x, io_pool.submit(RomHelpers.fileDigest, x)) for x in paths)
+            digests = dict((x, digests[x].result()) for x in digests)
+            lookups = [io_pool.submit(x._cacheLookup, digests) for x in self.handlers]
+
+            pending = []
+            for handler, files, lookup in zip(self.handlers, handler_files, lookups):
+                key, found = lookup.result()
+                if not found:
+                    pending.append((handler, key, files))
+
+            layers = {}
+            to_parse = {}
+            states = []
+            for handler, key, files in pending:
+                handler.defs = [(fl, None) for fl, _ in files]
+                file_digests = [digests[flpath] for _, flpath in files]
+                for digest, (_, flpath) in zip(file_digests, files):
+                    layer = DefLayer.registry.get(digest, None)
+                    if layer is not None:
+                        layers[digest] = layer
+                    else:
+                        to_parse[digest] = flpath
+                states.append([handler, key, file_digests, handler._orderedDefs(), 0])
+
+            def _layerReady(digest, layer):
+                DefLayer.registry[digest] = layer
+                layers[digest] = layer
+                for state in states:
+                    handler = state[0]
+                    for idx, x in enumerate(state[2]):
+                        if x == digest:
+                            handler.defs[idx] = (handler.defs[idx][0], layer)
+                states[:] = [x for x in states if not LoadPipeline._advance(x, layers)]
+
+            for handler, _, file_digests, _, _ in states:
+                for idx, digest in enumerate(file_digests):
+                    if digest in layers:
+                        handler.defs[idx] = (handler.defs[idx][0], layers[digest])
+            states[:] = [x for x in states if not LoadPipeline._advance(x, layers)]
+
+            # Parsed here, while the ROMs are read: returning the layers from worker
+            # processes (pickling) costs about as much as the parallel parse saves
+            for digest, flpath in to_parse.items():
+                with Metrics.measureFile(flpath):
+                    layer = DefLayer.parse(flpath, digest)
+                _layerReady(digest, layer)
+
+            for rom in roms:
+                rom.result()
+
+
+"""
+==========================
+    Batch mode
+==========================
+"""
+
+# Definitions shared with the batch workers: defs key -> (scalings, tables, protected tables)
+_batch_models = {}
+
+
+def _batchInit(models):
+    """Process pool initializer - receives the parsed definitions once per worker."""
+    global _batch_models
+    _batch_models = models
+
+
+def _batchWorker(idx, job):
+    """Run one batch job, using the shared definitions."""
+    result = {"index": idx, "source_rom": job["source_rom"], "dest_rom": job["dest_rom"]}
+    try:
+        source = RomHandler(job["source_rom"], job["source_defs"], readonly=True)
+        dest = RomHandler(job["dest_rom"], job["dest_defs"])
+        source.scalings, source.tables, source.protected = _batch_models[BatchRunner.defsKey(job["source_defs"])]
+        dest.scalings, dest.tables, dest.protected = _batch_models[BatchRunner.defsKey(job["dest_defs"])]
+        source.loadRom()
+        dest.loadRom()
+
+        tables = RomsOps.getCommonTablesWith(source, dest, job["address_match"])
+        source_hashes = TableHashes(source).load()
+        dest_hashes = TableHashes(dest).load()
+        skip = TableHashes.unchanged(source_hashes, dest_hashes, tables)
+
+        plan = CopyPlan.build(source, dest, job["address_match"], tables, skip)
+        before = bytes(dest.content) if job["copy_check"] else None
+        plan.apply(source, dest)
+        if before is not None:
+            plan.verify(source, dest, before)
+        copied = [x for x in tables if x not in skip]
+        verified = dest_hashes.verify(source_hashes, copied)
+        source_hashes.save()
+        if job["checksum"]:
+            result["checksums_repaired"], result["checksums_invalid"] = \
+                SubaruChecksum.fix(dest, None, job["checksum_verify"])
+        dest.dumpToFile()
+        dest_hashes.save()
+
+        result.update({"status": "ok", "tables": plan.tableCount(),
+                       "blocks": len(plan.blocks), "bytes": plan.byteCount(),
+                       "copied": len(copied), "skipped": len(skip), "verified": verified})
+    except Exception as e:
+        result.update({"status": "failed", "error": str(e)})
+    return result
+
+
+class BatchRunner(object):
+    """Run many ROM to ROM copy jobs, described in a JSON manifest.
+
+    The manifest is a list of jobs:
+        [{"source_rom": ..., "source_defs": ..., "dest_rom": ..., "dest_defs": ..., "nomatch": false}, ...]
+    Relative paths are relative to the manifest. Each distinct definitions
+    set is parsed once, in this process, and shared with the workers.
+    """
+
+    def __init__(self, jobs, workers=None, cache=None, defs_index=None, selection=None):
+        self.jobs = jobs
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.defs_index = defs_index
+        self.selection = selection
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def defsKey(defs):
+        if isinstance(defs, (list, tuple)):
+            return tuple(defs)
+        return defs
+
+    def _resolveJobs(self):
+        """Fill in missing definitions from the index and check for write conflicts."""
+        errors = {}
+        for idx, job in enumerate(self.jobs):
+            try:
+                for rom, defs in (("source_rom", "source_defs"), ("dest_rom", "dest_defs")):
+                    if job.get(defs) is None:
+                        check(self.defs_index is not None, error_missing_defs, job[rom])
+                        job[defs] = self.defs_index.resolveRom(job[rom])
+            except Exception as e:
+                errors[idx] = str(e)
+
+        sources = set(os.path.abspath(x["source_rom"]) for x in self.jobs)
+        dests = set()
+        for job in self.jobs:
+            dest = os.path.abspath(job["dest_rom"])
+            check(dest not in dests and dest not in sources, error_batch_dest_conflict, job["dest_rom"])
+            dests.add(dest)
+
+        return errors
+
+    def _loadModels(self, skip):
+        """Parse each distinct definitions set once. Failures are kept per set."""
+        models = {}
+        failures = {}
+        for idx, job in enumerate(self.jobs):
+            if idx in skip:
+                continue
+            for defs in (job["source_defs"], job["dest_defs"]):
+                key = BatchRunner.defsKey(defs)
+                if key in models or key in failures:
+                    continue
+                try:
+                    handler = RomHandler(None, defs, self.cache, selection=self.selection)
+                    handler.loadDefinitions()
+                    models[key] = (handler.scalings, handler.tables, handler.protected)
+                except Exception as e:
+                    failures[key] = str(e)
+        return models, failures
+
+    """ =========== Public. ============= """
+
+    @staticmethod
+    def loadManifest(path, address_match=True, checksum=False, copy_check=True, checksum_verify=False):
+        """Load jobs from a JSON manifest."""
+        with open(path, "r") as fp:
+            data = json.load(fp)
+        check(type(data) == type([]), error_invalid_manifest, path, "expected a list of jobs")
+
+        base = os.path.dirname(os.path.abspath(path))
+        def _path(x):
+            if x is None:
+                return None
+            if isinstance(x, list):
+                return [os.path.normpath(os.path.join(base, y)) for y in x]
+            return os.path.normpath(os.path.join(base, x))
+
+        jobs = []
+        for item in data:
+            for key in ("source_rom", "dest_rom"):
+                check(key in item, error_invalid_manifest, path, "job without " + key)
+            jobs.append({
+                "source_rom": _path(item["source_rom"]),
+                "source_defs": _path(item.get("source_defs")),
+                "dest_rom": _path(item["dest_rom"]),
+                "dest_defs": _path(item.get("dest_defs")),
+                "address_match": not item.get("nomatch", not address_match),
+                "checksum": item.get("checksum", checksum),
+                "checksum_verify": item.get("checksum_verify", checksum_verify),
+                "copy_check": item.get("copy_check", copy_check)
+                })
+        return jobs
+
+    def run(self):
+        """Run all jobs. Results are in job order, whatever the number of workers."""
+        errors = self._resolveJobs()
+        models, failures = self._loadModels(errors)
+
+        logging.info(info_batch_start.format(len(self.jobs), len(models) + len(failures), self.workers))
+
+        results = [None] * len(self.jobs)
+        todo = []
+        for idx, job in enumerate(self.jobs):
+            failed = [failures[BatchRunner.defsKey(x)] for x in (job["source_defs"], job["dest_defs"])
+                      if BatchRunner.defsKey(x) in failures]
+            if idx in errors:
+                failed.insert(0, errors[idx])
+            if failed:
+                results[idx] = {"index": idx, "source_rom": job["source_rom"], "dest_rom": job["dest_rom"],
+                                "status": "failed", "error": failed[0]}
+            else:
+                todo.append(idx)
+
+        if self.workers <= 1:
+            _batchInit(models)
+            for idx in todo:
+                results[idx] = _batchWorker(idx, self.jobs[idx])
+        else:
+            with concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_batchInit,
+                                                        initargs=(models,)) as executor:
+                futures = [executor.submit(_batchWorker, idx, self.jobs[idx]) for idx in todo]
+                for future in futures:
+                    result = future.result()
+                    results[result["index"]] = result
+
+        return results
+
+
+"""
+==========================
+    Watch mode
+==========================
+"""
+
+class RomWatcher(object):
+    """Keep a ROM pair loaded and copy again whenever one of their files changes.
+
+    The ROMs and definition files are polled (size and modification time).
+    A changed definition file is the only one parsed again, and the table
+    hashes of both ROMs are kept between copies: only the tables whose
+    definition or content changed are hashed and copied again.
+
+    The ROMs are kept in memory, not mapped: a mapped file can't be replaced
+    on Windows, and a mapped file truncated on Linux kills the process.
+    """
+
+    def __init__(self, source, dest, address_match=True, interval=watch_default_interval,
+                 checksum=False, checksum_table=None, hashes=None, copy_check=True, checksum_verify=False):
+        source.unmapRom()
+        dest.unmapRom()
+        self.source = source
+        self.dest = dest
+        self.copy_check = copy_check
+        self.address_match = address_match
+        self.interval = interval
+        self.checksum = checksum
+        self.checksum_table = checksum_table
+        self.checksum_verify = checksum_verify
+        if hashes is None:
+            hashes = (TableHashes(source).load(), TableHashes(dest).load())
+        self.source_hashes, self.dest_hashes = hashes
+        self.state = self._snapshot()
+
+    """ =========== Helpers. ============ """
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _snapshot(self):
+        """Retrieve path -> (role, stat) for the ROMs and definition files."""
+        state = {}
+        for role, handler in (("source", self.source), ("dest", self.dest)):
+            state[handler.rom_path] = (role + "_rom", RomWatcher._stat(handler.rom_path))
+            for _, flpath in handler._listDefs():
+                state[flpath] = (role + "_defs", RomWatcher._stat(flpath))
+        return state
+
+    def _changes(self):
+        """Retrieve the set of changed roles and the changed paths."""
+        state = self._snapshot()
+        paths = [x for x in set(state) | set(self.state) if state.get(x, None) != self.state.get(x, None)]
+        roles = set((state.get(x, None) or self.state[x])[0] for x in paths)
+        self.state = state
+        return roles, sorted(paths)
+
+    """ =========== Public. ============= """
+
+    def refresh(self, roles):
+        """Reload what changed and copy again. Returns (copied, skipped, bytes written)."""
+        if "source_defs" in roles:
+            self.source_hashes.forget(self.source.reloadDefinitions())
+        if "dest_defs" in roles:
+            self.dest_hashes.forget(self.dest.reloadDefinitions())
+        if "source_rom" in roles:
+            self.source.loadRom()
+            self.source_hashes = TableHashes(self.source).load()
+        if "dest_rom" in roles:
+            self.dest.loadRom()
+            self.dest_hashes = TableHashes(self.dest).load()
+
+        tables = RomsOps.getCommonTablesWith(self.source, self.dest, self.address_match)
+        skip = TableHashes.unchanged(self.source_hashes, self.dest_hashes, tables)
+        plan = CopyPlan.build(self.source, self.dest, self.address_match, tables, skip)
+        before = bytes(self.dest.content) if self.copy_check else None
+        plan.apply(self.source, self.dest)
+        if before is not None:
+            plan.verify(self.source, self.dest, before)
+
+        copied = [x for x in tables if x not in skip]
+        self.dest_hashes.verify(self.source_hashes, copied)
+        self.source_hashes.save()
+        if self.checksum:
+            SubaruChecksum.fix(self.dest, self.checksum_table, self.checksum_verify)
+
+        written = sum(y - x for x, y in self.dest.dirtyRanges())
+        self.dest.dumpToFile()
+        self.dest_hashes.save()
+        # Our own write is not a change
+        self.state = self._snapshot()
+        return len(copied), len(skip), written
+
+    def run(self, cycles=None):
+        """Poll for changes until interrupted (or for <cycles> polls)."""
+        logging.info(info_watch_start.format(len(self.state), self.interval))
+        cycle = 0
+        try:
+            while cycles is None or cycle < cycles:
+                cycle += 1
+                time.sleep(self.interval)
+                roles, paths = self._changes()
+                if not paths:
+                    continue
+
+                logging.info(info_watch_change.format(", ".join(paths)))
+                start = time.perf_counter()
+                try:
+                    copied, skipped, written = self.refresh(roles)
+                except Exception as e:
+                    # Typically a file caught while it is being written
+                    logging.warning(warning_watch_failed.format(e))
+                    continue
+                logging.info(info_watch_refresh.format(time.perf_counter() - start, copied, skipped, written))
+        except KeyboardInterrupt:
+            pass
+        logging.info(info_watch_stop)
 
 
 """
@@ -525,47 +3493,244 @@ class RomHandler(object):
 ==========================
 """
 
+def mainBatch(args):
+    """Batch mode main."""
+    cache = None
+    if args.use_cache:
+        cache = DefsCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    defs_index = None
+    if args.defs_repo:
+        defs_index = DefsIndex(args.defs_repo)
+        defs_index.update()
+
+    jobs = BatchRunner.loadManifest(args.batch, args.address_match, args.checksum, args.copy_check,
+                                   args.checksum_verify)
+    with Metrics.measure("batch"):
+        selection = TableSelection.fromOptions(args.include, args.exclude, args.selection)
+        results = BatchRunner(jobs, args.workers, cache, defs_index, selection).run()
+
+    for result in results:
+        if result["status"] == "ok":
+            logging.info(info_batch_job_ok.format(result["index"], result["source_rom"], result["dest_rom"],
+                                                  result["tables"], result["bytes"]))
+        else:
+            logging.info(info_batch_job_failed.format(result["index"], result["source_rom"], result["dest_rom"],
+                                                      result["error"]))
+
+    failed = len([x for x in results if x["status"] != "ok"])
+    logging.info(info_batch_summary.format(len(results) - failed, failed))
+
+    if args.batch_report:
+        with open(args.batch_report, "w") as fp:
+            json.dump(results, fp, indent=1)
+
+    return results
+
+
+def mainFleet(args):
+    """Fleet statistics main."""
+    rom_paths = FleetStats.listRoms(args.fleet)
+    check(rom_paths, error_fleet_empty, args.fleet)
+    reference = args.stock or FleetStats.referenceRom(rom_paths)
+
+    defs = args.fleet_defs
+    if defs is None:
+        checkNone(args.defs_repo, error_fleet_defs)
+        index = DefsIndex(args.defs_repo)
+        index.update()
+        defs = index.resolveRom(reference)
+
+    cache = None
+    if args.use_cache:
+        cache = DefsCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    selection = TableSelection.fromOptions(args.include, args.exclude, args.selection)
+    handler = RomHandler(reference, defs, cache, readonly=True, selection=selection)
+    with Metrics.measure("load"):
+        handler.load()
+
+    with Metrics.measure("fleet"):
+        stats = FleetStats(handler, rom_paths, args.stock).run()
+    logging.info(FleetStats.summary(stats))
+
+    FleetStats.save(stats, args.fleet_report)
+    logging.info(info_fleet_saved.format(args.fleet_report))
+    return stats
+
+
 def main(args):
     """Main."""
+    if args.batch:
+        mainBatch(args)
+        return
+
+    if args.fleet:
+        mainFleet(args)
+        return
+
+    if args.apply_patch or args.revert_patch:
+        path = args.apply_patch or args.revert_patch
+        count = RomPatch.apply(path, args.rom1, revert=args.revert_patch is not None)
+        logging.info(info_patch_applied.format("Reverted" if args.revert_patch else "Applied", path, args.rom1, count))
+        return
+
     logging.info(info_initial_action.format(args.rom1, args.rom2))
 
     # Load data
     logging.info(info_step1)
 
-    source_rom = RomHandler(args.rom1, args.def1)
-    dest_rom = RomHandler(args.rom2, args.def2)
-    source_rom.load()
-    dest_rom.load()
+    converter = None
+    dest_hashes = None
+    if args.replay_plan:
+        source_rom = RomHandler(args.rom1, None, readonly=True)
+        dest_rom = RomHandler(args.rom2, None)
+        source_rom.loadRom()
+        dest_rom.loadRom()
 
-    if args.outputdefs:
-        with open(args.rom1+".defs", "w") as fp:
-            fp.write(str(source_rom))
-        with open(args.rom2+".defs", "w") as fp:
-            fp.write(str(dest_rom))
+        plan = CopyPlan.load(args.replay_plan)
+        logging.info(info_plan_loaded.format(args.replay_plan))
+    else:
+        cache = None
+        if args.use_cache:
+            cache = DefsCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+        def1 = args.def1
+        def2 = args.def2
+        if args.defs_repo and (def1 is None or def2 is None):
+            index = DefsIndex(args.defs_repo)
+            index.update()
+            if def1 is None:
+                def1 = index.resolveRom(args.rom1)
+            if def2 is None:
+                def2 = index.resolveRom(args.rom2)
+
+        selection = TableSelection.fromOptions(args.include, args.exclude, args.selection)
+        source_rom = RomHandler(args.rom1, def1, cache, readonly=True, selection=selection)
+        dest_rom = RomHandler(args.rom2, def2, cache, readonly=args.diff, selection=selection)
+        with Metrics.measure("load"):
+            LoadPipeline([source_rom, dest_rom]).run()
+
+        if args.outputdefs:
+            with open(args.rom1+".defs", "w") as fp:
+                fp.write(str(source_rom))
+            with open(args.rom2+".defs", "w") as fp:
+                fp.write(str(dest_rom))
+
+        if args.diff:
+            with Metrics.measure("diff"):
+                report = RomDiff(source_rom, dest_rom).run()
+            logging.info(RomDiff.describe(report))
+            if args.diff_report:
+                with open(args.diff_report, "w") as fp:
+                    json.dump(report, fp, indent=1)
+                logging.info(info_diff_saved.format(args.diff_report))
+            return
+
+        with Metrics.measure("match"):
+            tables = RomsOps.getCommonTablesWith(source_rom, dest_rom, args.address_match)
+
+        if args.relocate:
+            with Metrics.measure("relocation"):
+                report = RelocationEngine(source_rom, dest_rom, args.reloc_window).run(tables)
+            tables = RelocationEngine.accepted(report)
+            logging.info(RelocationEngine.summary(report))
+            if args.reloc_report:
+                with open(args.reloc_report, "w") as fp:
+                    json.dump(report, fp, indent=1)
+
+        # A saved plan must be usable on other ROMs, so it keeps all tables
+        skip = ()
+        if not args.save_plan:
+            with Metrics.measure("hashes"):
+                source_hashes = TableHashes(source_rom).load()
+                dest_hashes = TableHashes(dest_rom).load()
+                skip = TableHashes.unchanged(source_hashes, dest_hashes, tables)
+            logging.info(info_hash_skip.format(len(skip)))
+
+        with Metrics.measure("plan"):
+            dest_rom.getAddressIndex().logOverlaps(args.rom2, dest_rom.getProtectedIndex())
+            plan = CopyPlan.build(source_rom, dest_rom, args.address_match, tables, skip)
+
+        if args.convert:
+            with Metrics.measure("convert"):
+                converter = TableConverter(source_rom, dest_rom, args.address_match)
+                logging.info(TableConverter.summary(converter.run()))
 
     logging.info(info_step1_finish)
-    logging.info(info_step2)
 
-    RomsOps.copyRomData(source_rom, dest_rom, args.address_match)
+    if args.save_plan:
+        plan.save(args.save_plan)
+        logging.info(info_plan_saved.format(args.save_plan))
+
+    if args.dry_run:
+        logging.info(plan.describe())
+        logging.info(info_dry_run)
+        return
+
+    logging.info(info_step2)
+    logging.info(info_plan.format(plan.tableCount(), len(plan.blocks), plan.byteCount()))
+
+    before = bytes(dest_rom.content) if args.copy_check else None
+    with Metrics.measure("copy"):
+        plan.apply(source_rom, dest_rom)
+
+    # Before conversions and checksums, which legitimately change other ranges
+    if before is not None:
+        with Metrics.measure("copycheck"):
+            compared = plan.verify(source_rom, dest_rom, before)
+        logging.info(info_copy_check.format(len(plan.blocks), compared))
+
+    if converter is not None:
+        with Metrics.measure("convert"):
+            converter.apply()
+
+    if dest_hashes is not None:
+        copied = [x for x in tables if x not in skip]
+        if converter is not None:
+            dest_hashes.forget(converter.converted)
+        with Metrics.measure("verify"):
+            verified = dest_hashes.verify(source_hashes, copied)
+        logging.info(info_copy_summary.format(len(copied), len(skip), verified))
+        # The source does not change any more, its next run can use these
+        source_hashes.save()
+
+    if args.checksum:
+        with Metrics.measure("checksum"):
+            SubaruChecksum.fix(dest_rom, args.checksum_table, args.checksum_verify)
+
+    if args.patch:
+        with Metrics.measure("patch"):
+            records, size = RomPatch.export(dest_rom, args.patch)
+        logging.info(info_patch_saved.format(args.patch, records, size, args.rom2))
+        return
 
     logging.info(info_step3)
 
-    source_rom.dumpToFile()
-    dest_rom.dumpToFile()
+    with Metrics.measure("write"):
+        dest_rom.dumpToFile()
+        if dest_hashes is not None:
+            dest_hashes.save()
+
+    if args.watch:
+        RomWatcher(source_rom, dest_rom, args.address_match, args.watch_interval, args.checksum,
+                   args.checksum_table, (source_hashes, dest_hashes), args.copy_check,
+                   args.checksum_verify).run()
 
 
 def parseArgs():
     """Parsing arguments."""
     epilog = """
-    In this version, the definitions for each ROM must be manually selected.
-    You take your ROM definition (az1g202g.xml for example) and follow the include trail
-    (look inside the XML for the <include> tag) till you copy all the files (you reach 32bitbase.xml)
+    The definitions for each ROM can be manually selected:
+    you take your ROM definition (az1g202g.xml for example) and follow the include trail
+    (look inside the XML for the <include> tag) till you copy all the files (you reach 32bitbase.xml).
+    Or you can point --defsrepo to your full definitions tree and leave out def1 / def2:
+    the ROM is identified from its content and the include trail is resolved automatically.
     """
     parser = argparse.ArgumentParser(description='Copy one ROM settings to another.', epilog=epilog)
-    parser.add_argument('rom1', help='Source ROM from which to copy (OLD ONE)')
-    parser.add_argument('rom2', help='Destination ROM to which to copy (NEW ONE)')
-    parser.add_argument('def1', help='Definitions for the first ROM, all in one folder (just them)')
-    parser.add_argument('def2', help='Definitions for the second ROM, all in a second folder (just them)')
+    parser.add_argument('rom1', nargs='?', help='Source ROM from which to copy (OLD ONE)')
+    parser.add_argument('rom2', nargs='?', help='Destination ROM to which to copy (NEW ONE)')
+    parser.add_argument('def1', nargs='?', help='Definitions for the first ROM, all in one folder (just them)')
+    parser.add_argument('def2', nargs='?', help='Definitions for the second ROM, all in a second folder (just them)')
     parser.add_argument('--nomatch', '-n', dest='address_match', action='store_const',
                         const=False, default=True,
                         help='The addresses of the tables must not perfectly match (default to TRUE)')
@@ -575,6 +3740,91 @@ def parseArgs():
     parser.add_argument('--outputdefs', '-o', dest='outputdefs', action='store_const',
                         const=True, default=False,
                         help='Output table tree of defs to files on disk.')
+    parser.add_argument('--include', dest='include', action='append', default=None,
+                        help='Only load the tables matching this rule (name, glob:..., re:..., category:...). '
+                             'Can be repeated.')
+    parser.add_argument('--exclude', dest='exclude', action='append', default=None,
+                        help='Do not load the tables matching this rule. Can be repeated. '
+                             'ECU Identifier tables are always excluded.')
+    parser.add_argument('--selection', dest='selection', default=None,
+                        help='File with table selection rules, one per line: +rule to include, -rule to exclude.')
+    parser.add_argument('--nocache', dest='use_cache', action='store_const',
+                        const=False, default=True,
+                        help='Do not use the processed definitions cache.')
+    parser.add_argument('--clearcache', dest='clear_cache', action='store_const',
+                        const=True, default=False,
+                        help='Remove all entries from the definitions cache before running.')
+    parser.add_argument('--cachedir', dest='cache_dir', default=cache_default_dir,
+                        help='Folder for the definitions cache (default: {0})'.format(cache_default_dir))
+    parser.add_argument('--cachesize', dest='cache_size', type=int, default=cache_default_size_mb,
+                        help='Maximum size of the definitions cache, in MB (default: {0})'.format(cache_default_size_mb))
+    parser.add_argument('--defsrepo', dest='defs_repo', default=None,
+                        help='Full definitions tree, used for the ROMs without a definitions folder.')
+    parser.add_argument('--saveplan', dest='save_plan', default=None,
+                        help='Save the copy plan (merged copy blocks) to this file.')
+    parser.add_argument('--replay', dest='replay_plan', default=None,
+                        help='Apply a saved copy plan, without loading any definitions.')
+    parser.add_argument('--dryrun', dest='dry_run', action='store_const',
+                        const=True, default=False,
+                        help='Only show the copy plan, do not write any ROM.')
+    parser.add_argument('--relocate', dest='relocate', action='store_const',
+                        const=True, default=False,
+                        help='Search the table axes in the destination ROM and refuse tables whose axes are not found '
+                             'at the destination address (use with --nomatch, needs numpy).')
+    parser.add_argument('--relocwindow', dest='reloc_window', type=int, default=None,
+                        help='Only search axes this many bytes around the destination address (default: whole ROM).')
+    parser.add_argument('--relocreport', dest='reloc_report', default=None,
+                        help='Write the relocation check results as JSON to this file.')
+    parser.add_argument('--convert', dest='convert', action='store_const',
+                        const=True, default=False,
+                        help='Also copy tables whose scaling changed, converting their values (needs numpy).')
+    parser.add_argument('--diff', dest='diff', action='store_const',
+                        const=True, default=False,
+                        help='Only show the differences between the ROMs, by table. No ROM is written.')
+    parser.add_argument('--diffreport', dest='diff_report', default=None,
+                        help='Write the differences as JSON to this file (with --diff).')
+    parser.add_argument('--nocopycheck', dest='copy_check', action='store_const',
+                        const=False, default=True,
+                        help='Do not check the destination ROM after the copy (size, copied ranges, nothing else changed).')
+    parser.add_argument('--checksum', dest='checksum', action='store_const',
+                        const=True, default=False,
+                        help='Repair the checksums of the destination ROM (32-bit Subaru) touched by the copy (needs numpy).')
+    parser.add_argument('--checksumtable', dest='checksum_table', type=lambda x: int(x, 0), default=None,
+                        help='Address of the checksum table (default: search for it).')
+    parser.add_argument('--checksumverify', dest='checksum_verify', action='store_const',
+                        const=True, default=False,
+                        help='Verify every checksum of the table after the repair, not only the repaired ones.')
+    parser.add_argument('--patch', dest='patch', default=None,
+                        help='Save the changes as a binary patch to this file, instead of writing the destination ROM.')
+    parser.add_argument('--applypatch', dest='apply_patch', default=None,
+                        help='Write this patch on rom1 (no definitions needed).')
+    parser.add_argument('--revertpatch', dest='revert_patch', default=None,
+                        help='Take this patch back from rom1 (no definitions needed).')
+    parser.add_argument('--watch', dest='watch', action='store_const',
+                        const=True, default=False,
+                        help='After the copy, keep watching the ROMs and definitions and copy again when they change.')
+    parser.add_argument('--watchinterval', dest='watch_interval', type=float, default=watch_default_interval,
+                        help='Seconds between checks for changes in watch mode (default: {0}).'.format(
+                            watch_default_interval))
+    parser.add_argument('--fleet', dest='fleet', default=None,
+                        help='Table statistics over all the ROMs of this folder (or listed in this file), '
+                             'which share one definitions set (needs numpy).')
+    parser.add_argument('--fleetdefs', dest='fleet_defs', default=None,
+                        help='Definitions of the fleet ROMs (default: resolved with --defsrepo).')
+    parser.add_argument('--stock', dest='stock', default=None,
+                        help='Stock ROM the fleet is compared to (default: most common data of each table).')
+    parser.add_argument('--fleetreport', dest='fleet_report', default=fleet_default_report,
+                        help='Fleet statistics output, numpy .npz columns (default: {0}).'.format(fleet_default_report))
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='Write time and peak memory of each phase and definition file, and counters, as JSON to this file.')
+    parser.add_argument('--profiledump', dest='profile_dump', default=None,
+                        help='Also run under cProfile and save the statistics to this file (for pstats / snakeviz).')
+    parser.add_argument('--batch', dest='batch', default=None,
+                        help='Run all the jobs from this JSON manifest instead of a single ROM pair.')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='Number of worker processes for batch mode (default: number of CPUs).')
+    parser.add_argument('--batchreport', dest='batch_report', default=None,
+                        help='Write the batch results as JSON to this file.')
 
     args = parser.parse_args()
     return args
@@ -582,13 +3832,50 @@ def parseArgs():
 
 def validateInput(args):
     """Validate the input."""
-    if not os.path.exists(args.rom1):
+    if args.defs_repo is not None and not os.path.isdir(args.defs_repo):
+        myerror(error_invalid_path.format("Defsrepo"))
+    if args.selection is not None and not os.path.exists(args.selection):
+        myerror(error_invalid_path.format("Selection"))
+    if args.watch:
+        for option, used in (("--batch", args.batch), ("--replay", args.replay_plan), ("--dryrun", args.dry_run),
+                             ("--saveplan", args.save_plan), ("--patch", args.patch), ("--diff", args.diff),
+                             ("--relocate", args.relocate), ("--convert", args.convert)):
+            check(not used, error_watch_mode, option)
+    if args.batch is not None:
+        if not os.path.exists(args.batch):
+            myerror(error_invalid_path.format("Batch manifest"))
+        return
+    if args.fleet is not None:
+        if not os.path.exists(args.fleet):
+            myerror(error_invalid_path.format("Fleet"))
+        if args.stock is not None and not os.path.exists(args.stock):
+            myerror(error_invalid_path.format("Stock"))
+        if args.fleet_defs is not None and not os.path.exists(args.fleet_defs):
+            myerror(error_invalid_path.format("Fleetdefs"))
+        if args.fleet_defs is None and args.defs_repo is None:
+            myerror(error_fleet_defs)
+        return
+    if args.rom1 is None or not os.path.exists(args.rom1):
         myerror(error_invalid_path.format("Rom1"))
-    if not os.path.exists(args.rom2):
+    for patch in (args.apply_patch, args.revert_patch):
+        if patch is not None:
+            if not os.path.exists(patch):
+                myerror(error_invalid_path.format("Patch"))
+            return
+    if args.rom2 is None or not os.path.exists(args.rom2):
         myerror(error_invalid_path.format("Rom2"))
-    if not os.path.exists(args.def1):
+    if args.replay_plan is not None:
+        check(not args.diff, error_diff_replay)
+        if not os.path.exists(args.replay_plan):
+            myerror(error_invalid_path.format("Replay plan"))
+        return
+    if args.def1 is None and args.defs_repo is None:
+        myerror(error_missing_defs.format("Rom1"))
+    if args.def2 is None and args.defs_repo is None:
+        myerror(error_missing_defs.format("Rom2"))
+    if args.def1 is not None and not os.path.exists(args.def1):
         myerror(error_invalid_path.format("Def1"))
-    if not os.path.exists(args.def2):
+    if args.def2 is not None and not os.path.exists(args.def2):
         myerror(error_invalid_path.format("Def2"))
 
 
@@ -599,10 +3886,36 @@ def setup(args):
     else:
         logging.basicConfig(level=logging.INFO)
 
+    if args.clear_cache:
+        removed = DefsCache(args.cache_dir).invalidate()
+        logging.info(info_cache_cleared.format(removed, args.cache_dir))
+
+    if args.profile:
+        Metrics.enable()
+
+
+def finish(args, profiler=None):
+    """Save the profiling results."""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_dump)
+        logging.info(info_profile_dump_saved.format(args.profile_dump))
+
+    if Metrics.current is not None:
+        Metrics.current.save(args.profile)
+        Metrics.disable()
+        logging.info(info_profile_saved.format(args.profile))
+
 
 if __name__ == "__main__":
     args = parseArgs()
     validateInput(args)
     setup(args)
-    
+
+    profiler = None
+    if args.profile_dump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     main(args)
+    finish(args, profiler)